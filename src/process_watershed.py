@@ -75,11 +75,9 @@ def run_model(watershed_id):
     smooth_z.main()
     compute_vertex_gradient.main()
     load_habitat_access_updates.main()
+    #elevations are carried through to the broken streams
+    #so they do not need to be recalculated
     break_streams_at_barriers.main()
-    print ("Recalculating elevations on broken streams: " + watershed_id)
-    #re-assign elevations to broken streams
-    assign_raw_z.main(dem_files)
-    smooth_z.main()
     compute_segment_gradient.main()
     compute_updown_barriers_fish.main()
     compute_accessibility.main()
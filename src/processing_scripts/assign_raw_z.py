@@ -25,13 +25,21 @@ import appconfig
 import os
 import numpy
 import tifffile as tif
+import shapely
 import shapely.wkb
 import shapely.geometry
+from shapely.strtree import STRtree
 from math import floor
 import json
-import psycopg2.extras
 from psycopg2.extras import RealDictCursor
 import ast
+import multiprocessing
+from collections import OrderedDict
+
+if __package__:
+    from . import bulk_update
+else:
+    import bulk_update
 
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -46,8 +54,13 @@ else:
 
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 demDir = appconfig.demDir
+demCacheSize = appconfig.config['ELEVATION_PROCESSING'].getint('dem_cache_size', 8)
+demWorkers = appconfig.config['ELEVATION_PROCESSING'].getint('dem_workers', 1)
+demMosaic = appconfig.config['ELEVATION_PROCESSING'].getboolean('dem_mosaic', False)
+demCatalogFile = os.path.join(demDir, appconfig.config['ELEVATION_PROCESSING'].get('dem_catalog', 'dem_catalog.json'))
 
 demfiles = []
+demIndex = None
 
 class DEMFile:
     def __init__(self, filename, xmin, ymin, xmax, ymax, xcellsize, ycellsize, xcnt, ycnt, srid, nodata):
@@ -62,6 +75,139 @@ class DEMFile:
         self.ycnt = ycnt
         self.srid = srid
         self.nodata = nodata
+
+class DEMReader:
+    """
+    Provides access to dem file data. Each file is memory mapped once
+    (only the pages that are accessed are read from disk) and the most 
+    recently used files are kept open so coordinates that fall in 
+    neighbouring files can be sampled without reopening them.
+    """
+    def __init__(self, maxopen):
+        self.maxopen = maxopen
+        self.files = OrderedDict()
+    
+    def getData(self, demfile):
+        if (demfile.filename in self.files):
+            self.files.move_to_end(demfile.filename)
+            return self.files[demfile.filename]
+        
+        try:
+            data = tif.memmap(demfile.filename, mode='r')
+        except ValueError:
+            #compressed or tiled files cannot be memory mapped
+            data = numpy.asarray(tif.imread(demfile.filename))
+        
+        self.files[demfile.filename] = data
+        if (len(self.files) > self.maxopen):
+            self.files.popitem(last=False)
+        return data
+    
+    def readWindow(self, demfile, xindex, yindex):
+        """
+        Reads the block of cells covering the provided cell indexes 
+        plus the neighbouring cells required for interpolation
+        
+        :returns: the cell values and the (row, column) offset of the 
+            window within the dem file
+        """
+        xmin = min(max(int(xindex.min()) - 1, 0), demfile.xcnt)
+        xmax = min(max(int(xindex.max()) + 2, 0), demfile.xcnt)
+        ymin = min(max(int(yindex.min()) - 1, 0), demfile.ycnt)
+        ymax = min(max(int(yindex.max()) + 2, 0), demfile.ycnt)
+        
+        data = self.getData(demfile)
+        return numpy.array(data[ymin:ymax, xmin:xmax]), ymin, xmin
+    
+    def close(self):
+        self.files.clear()
+
+demReader = DEMReader(demCacheSize)
+
+class DEMIndex:
+    """
+    Spatial index over the extents of the dem files
+    """
+    def __init__(self, files):
+        self.files = list(files)
+        self.tree = STRtree([shapely.geometry.box(f.xmin, f.ymin, f.xmax, f.ymax) for f in self.files])
+    
+    def findFiles(self, x, y):
+        """
+        :returns: the dem files whose extent contains the point
+        """
+        indexes = self.tree.query(shapely.geometry.Point(x, y), predicate='intersects')
+        return [self.files[i] for i in sorted(indexes)]
+    
+    def locate(self, x, y):
+        """
+        :returns: array with the index of the dem file containing each 
+            point; -1 for points not in any dem file
+        """
+        pointindex, fileindex = self.tree.query(shapely.points(x, y), predicate='intersects')
+        
+        #points on a shared edge are in multiple files; use the first file
+        order = numpy.argsort(-fileindex, kind='stable')
+        located = numpy.full(len(x), -1, dtype=numpy.int64)
+        located[pointindex[order]] = fileindex[order]
+        return located
+
+class VirtualMosaic:
+    """
+    Presents all the dem files as a single grid so points near the edge 
+    of a file are interpolated using the cells of the neighbouring files.
+    The dem files must have the same projection, cell size and alignment.
+    """
+    def __init__(self, index):
+        self.index = index
+        
+        first = index.files[0]
+        xmin = min(f.xmin for f in index.files)
+        ymin = min(f.ymin for f in index.files)
+        xmax = max(f.xmax for f in index.files)
+        ymax = max(f.ymax for f in index.files)
+        xcnt = round((xmax - xmin) / first.xcellsize)
+        ycnt = round((ymax - ymin) / abs(first.ycellsize))
+        
+        self.grid = DEMFile(None, xmin, ymin, xmax, ymax, first.xcellsize, first.ycellsize, xcnt, ycnt, first.srid, first.nodata)
+    
+    def isSupported(self):
+        """
+        :returns: true if all dem files line up with the mosaic grid
+        """
+        for f in self.index.files:
+            if (f.srid != self.grid.srid or 
+                not numpy.isclose(f.xcellsize, self.grid.xcellsize) or 
+                not numpy.isclose(abs(f.ycellsize), abs(self.grid.ycellsize))):
+                return False
+            offset = (f.xmin - self.grid.xmin) / self.grid.xcellsize
+            if (not numpy.isclose(offset, round(offset))):
+                return False
+            offset = (f.ymin - self.grid.ymin) / abs(self.grid.ycellsize)
+            if (not numpy.isclose(offset, round(offset))):
+                return False
+        return True
+    
+    def cellValues(self, xi, yi, xc, yc):
+        #cells are read from the dem file containing the cell center
+        values = numpy.full(len(xi), appconfig.NODATA, dtype=numpy.float64)
+        fileindex = self.index.locate(xc, yc)
+        
+        for i in numpy.unique(fileindex[fileindex >= 0]):
+            demfile = self.index.files[i]
+            cells = numpy.flatnonzero(fileindex == i)
+            
+            #centers on the maximum edge fall just outside the last cell
+            txi, tyi = cellIndex(demfile, xc[cells], yc[cells])
+            txi = numpy.clip(txi, 0, demfile.xcnt - 1)
+            tyi = numpy.clip(tyi, 0, demfile.ycnt - 1)
+            
+            window, rowoffset, coloffset = demReader.readWindow(demfile, txi, tyi)
+            tilevalues = window[tyi - rowoffset, txi - coloffset].astype(numpy.float64)
+            tilevalues[tilevalues == demfile.nodata] = self.grid.nodata
+            values[cells] = tilevalues
+        
+        return values
         
 def getWatershedIds(conn):
     
@@ -108,13 +254,48 @@ def prepareOutput(conn):
 def indexDem():
     #read all files in dem
     #get bounds
-    #build index of 
+    #file details are cached in the dem catalog and only
+    #re-read with gdal when the file has been modified
     print("indexing dem files")
+    catalog = loadCatalog()
+    newcatalog = {}
+    
     demfiles = [];
-    for demfile in os.listdir(demDir):
+    for demfile in sorted(os.listdir(demDir)):
         if (demfile.endswith('.tif') or demfile.endswith('.tiff')):
-            demfiles.append(getFileDetails(os.path.join(demDir,demfile)))
+            filename = os.path.join(demDir,demfile)
+            stat = os.stat(filename)
+            
+            entry = catalog.get(filename)
+            if (entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size):
+                details = DEMFile(filename, **entry['details'])
+            else:
+                details = getFileDetails(filename)
+            
+            demfiles.append(details)
+            newcatalog[filename] = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                'details': {k: v for k, v in vars(details).items() if k != 'filename'}}
+    
+    if (newcatalog != catalog):
+        saveCatalog(newcatalog)
     return demfiles
+
+def loadCatalog():
+    if (not os.path.exists(demCatalogFile)):
+        return {}
+    try:
+        with open(demCatalogFile) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print("    WARNING: unable to read dem catalog " + demCatalogFile + "; rebuilding")
+        return {}
+
+def saveCatalog(catalog):
+    try:
+        with open(demCatalogFile, 'w') as f:
+            json.dump(catalog, f, indent=2)
+    except OSError:
+        print("    WARNING: unable to write dem catalog " + demCatalogFile)
   
 def getFileDetails(demfile):
     print("    reading: " + demfile)
@@ -147,7 +328,17 @@ def getFileDetails(demfile):
 def processArea(demfile, connection, watershed_id, onlymissing = False):
     print("    processing: " + (demfile.filename))
     
-    #get edges
+    srid, features = loadFeatures(demfile, connection, watershed_id, onlymissing)
+    if (len(features) == 0):
+        return
+    
+    newvalues = computeArea(demfile, features, onlymissing)
+    
+    print("      saving results")
+    writeArea(demfile, connection, srid, newvalues)
+
+
+def getStreamSrid(connection):
     query = f"""
         SELECT srid 
         FROM public.geometry_columns
@@ -161,6 +352,18 @@ def processArea(demfile, connection, watershed_id, onlymissing = False):
     with connection.cursor() as cursor:
         cursor.execute(query)
         srid = cursor.fetchone()[0]
+    return srid
+
+
+def loadFeatures(demfile, connection, watershed_id, onlymissing):
+    """
+    Loads the stream features that intersect the dem file
+    
+    :returns: the srid of the stream table and the list of (id, geometry) 
+        features, with geometries in the dem projection
+    """
+    #get edges
+    srid = getStreamSrid(connection)
     
     if onlymissing: 
         #only load features with at least one missing elevation values  
@@ -201,150 +404,304 @@ def processArea(demfile, connection, watershed_id, onlymissing = False):
             WHERE t.{dbTargetGeom} && env.bbox AND t.{appconfig.dbWatershedIdField} = {watershed_id}
         """
     #print(query)
-
-    newvalues = [] 
     
     with connection.cursor() as cursor:
-        
-            cursor.execute(query)
-            features = cursor.fetchall()
-            if (len(features) == 0):
-                return
-            print("      reading dem")
-            imarray = numpy.array(tif.imread(demfile.filename))
-            
-            print("      processing")
-            for feature in features:
-                geom = shapely.wkb.loads(feature[1] , hex=True)
-                fid = feature[0]
-                #print("processing: " + str(fid))
-                ls = processGeometry(geom, demfile, imarray, onlymissing)
-                newvalues.append(  (shapely.wkb.dumps(ls), fid) )
-                
-            imarray = None
-            connection.commit()
+        cursor.execute(query)
+        features = cursor.fetchall()
+    connection.commit()
     
-    print("      saving results")
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetTable} 
-        set {dbTargetGeom} = st_transform(
-            st_setsrid(st_geomfromwkb(%s),{demfile.srid}),
-            {srid})
-        WHERE {appconfig.dbIdField} = %s
+    return srid, features
+
+
+def computeArea(demfile, features, onlymissing):
     """
+    Computes the elevations of all vertices of the features
     
-    with connection.cursor() as cursor2:
-        psycopg2.extras.execute_batch(cursor2, updatequery, newvalues);
-            
+    :returns: list of (id, (N,3) coordinate array) for each feature
+    """
+    fids, coords, offsets = decodeFeatures(features)
+    
+    #only read the part of the dem covering the features
+    xindex, yindex = cellIndex(demfile, coords[:, 0], coords[:, 1])
+    window, rowoffset, coloffset = demReader.readWindow(demfile, xindex, yindex)
+    
+    #sample all vertices of all features in a single batch
+    z = sampleElevations(coords, demfile, tileCellValues(demfile, window, rowoffset, coloffset, onlymissing))
+    
+    return splitFeatures(fids, coords, z, offsets)
+
+
+def decodeFeatures(features):
+    """
+    Decodes the feature geometries into a single coordinate array
+    
+    :returns: feature ids, (N,3) array of all coordinates and the offset
+        of the first coordinate of each feature (plus the total count)
+    """
+    fids = []
+    coords = []
+    for feature in features:
+        geom = shapely.wkb.loads(feature[1] , hex=True)
+        fids.append(feature[0])
+        coords.append(numpy.asarray(geom.coords))
+    
+    offsets = numpy.cumsum([0] + [len(c) for c in coords])
+    coords = numpy.concatenate(coords)
+    return fids, coords, offsets
+
+
+def splitFeatures(fids, coords, z, offsets):
+    """
+    :returns: list of (id, (N,3) coordinate array) for each feature
+    """
+    newvalues = []
+    for i in range(len(fids)):
+        pnts = numpy.column_stack((coords[offsets[i]:offsets[i+1], 0:2], z[offsets[i]:offsets[i+1]]))
+        newvalues.append( (fids[i], pnts) )
+    return newvalues
+
+
+def processMosaic(mosaic, connection, watershed_id):
+    """
+    Computes the elevations of all features in the watershed in a single
+    pass over the virtual mosaic of all dem files
+    """
+    srid = getStreamSrid(connection)
+    
+    query = f"""
+        SELECT t.{appconfig.dbIdField} as id, st_transform(t.{dbTargetGeom}, {mosaic.grid.srid}) as geometry
+        FROM {dbTargetSchema}.{dbTargetTable} t
+        WHERE t.{appconfig.dbWatershedIdField} = {watershed_id}
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
     connection.commit()
     
+    if (len(features) == 0):
+        return
+    
+    print("    processing " + str(len(features)) + " features")
+    fids, coords, offsets = decodeFeatures(features)
+    z = sampleElevations(coords, mosaic.grid, mosaic.cellValues)
     
+    print("    saving results")
+    writeArea(mosaic.grid, connection, srid, splitFeatures(fids, coords, z, offsets))
+
+
+def writeArea(demfile, connection, srid, newvalues):
     
-def processGeometry(geom, demfile, demdata, onlymissing):
+    values = ((fid, shapely.wkb.dumps(shapely.geometry.LineString(pnts))) for fid, pnts in newvalues)
     
-    newpnts = []
-    for c in geom.coords:
-        x = c[0]
-        y = c[1]
-        z = c[2]
-        newpnts.append(processCoordinate(x, y, z, demfile, demdata, onlymissing))
+    bulk_update.updateTable(connection, f"{dbTargetSchema}.{dbTargetTable}", appconfig.dbIdField,
+        [("id", "uuid"), ("geometry", "geometry")], values,
+        {dbTargetGeom: f"st_transform(st_setsrid(s.geometry, {demfile.srid}), {srid})"})
             
-    #make a geometry from newpnts
-    ls = shapely.geometry.LineString(newpnts)
-    return ls   
+    connection.commit()
+
 
+def processAreaWorker(task):
+    """
+    Loads and computes the elevations for a single dem file in a 
+    worker process. Each worker reads with its own connection; the
+    results are returned to the main process for writing.
+    """
+    demfile, watershed_id, onlymissing = task
+    
+    connection = appconfig.connectdb()
+    try:
+        srid, features = loadFeatures(demfile, connection, watershed_id, onlymissing)
+    finally:
+        connection.close()
+    
+    if (len(features) == 0):
+        return demfile, srid, []
+    return demfile, srid, computeArea(demfile, features, onlymissing)
 
-def processCoordinate(x, y, z, demfile, demdata, onlymissing):
 
-    #find the dem cell and use that for now
-    xindex = floor((x - demfile.xmin) / demfile.xcellsize)
-    yindex = demfile.ycnt - floor((y - demfile.ymin) / abs(demfile.ycellsize)) - 1
-         
-    centerx = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
-    centery = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
+def processAreasParallel(connection, watershed_id, onlymissing, workers):
+    """
+    Processes all dem files using a pool of worker processes. Results
+    are written by a single connection as each dem file is completed.
+    
+    A feature that crosses dem files is computed by each of those files 
+    and the results may be written in any order, so the vertex elevations
+    computed so far are merged and the combined geometry is written.
+    """
+    merged = {}
+    tasks = [(demfile, watershed_id, onlymissing) for demfile in demfiles]
+    
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers) as pool:
+        for demfile, srid, newvalues in pool.imap_unordered(processAreaWorker, tasks):
+            print("    processed: " + (demfile.filename))
             
-    if ( x < centerx ):
-        xindex2 = xindex - 1
-    else:
-        xindex2 = xindex + 1
-                
-    if ( y < centery ):
-        yindex2 = yindex + 1
-    else:
-        yindex2 = yindex - 1
-     
+            for fid, pnts in newvalues:
+                if fid in merged:
+                    previous = merged[fid]
+                    nodata = pnts[:, 2] == appconfig.NODATA
+                    pnts[nodata, 2] = previous[nodata, 2]
+                merged[fid] = pnts
+            
+            writeArea(demfile, connection, srid, newvalues)
+    
     
-    if (onlymissing == False):
-        #if out of range return no data for now - we will go back and deal with 
-        #points that require multiple files later
+def cellIndex(demfile, x, y):
+    """
+    :returns: the column and row index of the dem cells containing the coordinates
+    """
+    xindex = numpy.floor((x - demfile.xmin) / demfile.xcellsize).astype(numpy.int64)
+    yindex = demfile.ycnt - numpy.floor((y - demfile.ymin) / abs(demfile.ycellsize)).astype(numpy.int64) - 1
+    return xindex, yindex
+
+
+def tileCellValues(demfile, demdata, rowoffset, coloffset, onlymissing):
+    """
+    Creates a function to look up cell values from a single dem file
+    
+    :param demfile: DEMFile details
+    :param demdata: dem cell values; either the entire file or a window
+    :param rowoffset: row index of the first row of demdata within the dem file
+    :param coloffset: column index of the first column of demdata within the dem file
+    :param onlymissing: if true, cells outside the dem are searched for in 
+        the other dem files; otherwise these coordinates keep their existing z
+    """
+    def cellValues(xi, yi, xc, yc):
+        #if out of range use no data for now - we will go back and 
+        #deal with points that require multiple files later
         #often dem files will overlap a bit so this edge will
         #be processed by another area
-        if (xindex < 0 or xindex >= demfile.xcnt or yindex < 0 or yindex >= demfile.ycnt  or
-            xindex2 < 0 or xindex2 >= demfile.xcnt or yindex2 < 0 or yindex2 >= demfile.ycnt ): 
-            return [x, y, z]
-   
-    
-    x1 = xindex * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
-    x2 = xindex2 * demfile.xcellsize + demfile.xmin + 0.5 * demfile.xcellsize
-    y1 = (demfile.ycnt - yindex -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
-    y2 =  (demfile.ycnt - yindex2 -1) * abs(demfile.ycellsize) + demfile.ymin + 0.5 * abs(demfile.ycellsize)
-    
-    if (xindex >= 0 and yindex >= 0 and xindex < demfile.xcnt and yindex < demfile.ycnt):
-        zx1y1 = demdata[yindex][xindex]
-    else:
-        zx1y1 = findElevation(x1, y1)
-        
-    if (xindex2 >= 0 and yindex >= 0 and xindex2 < demfile.xcnt and yindex < demfile.ycnt):
-        zx2y1 = demdata[yindex][xindex2]
-    else:
-        zx2y1 = findElevation(x2, y1)
-        
-    if (xindex2 >= 0 and yindex2 >= 0 and xindex2 < demfile.xcnt and yindex2 < demfile.ycnt):
-        zx2y2 = demdata[yindex2][xindex2]
-    else:
-        zx2y2 = findElevation(x2, y2)
-        
-    if (xindex >= 0 and yindex2 >= 0 and xindex < demfile.xcnt and yindex2 < demfile.ycnt):    
-        zx1y2 = demdata[yindex2][xindex]
-    else:
-        zx1y2 = findElevation(x1, y2)
-                
-    if (zx1y1 == appconfig.NODATA or zx1y2 == appconfig.NODATA or zx2y2 == appconfig.NODATA or zx1y2 == appconfig.NODATA):
-        #no data for this points
-        return [x,y,z]
-               
-    if (zx1y1 == demfile.nodata or zx2y1 == demfile.nodata or
-        zx2y1 == demfile.nodata or zx2y2 == demfile.nodata ):
-        #not enough data to determine
-        return [x, y, appconfig.NODATA]
-        
-    #bilinear interpolation of  elevation
-    fxy1 = ((x2 - x) / (x2- x1))*zx1y1 + ((x - x1)/(x2 - x1))*zx2y1
-    fxy2 = ((x2 - x) / (x2- x1))*zx1y2 + ((x - x1)/(x2 - x1))*zx2y2
-    fxy = ((y2 - y) / (y2 - y1))*fxy1 + ((y - y1)/(y2 - y1))*fxy2
-        
-    return [x,y,fxy]
+        inside = (xi >= 0) & (xi < demfile.xcnt) & (yi >= 0) & (yi < demfile.ycnt)
+        values = numpy.full(len(xi), appconfig.NODATA, dtype=numpy.float64)
+        values[inside] = demdata[yi[inside] - rowoffset, xi[inside] - coloffset]
+        if (onlymissing):
+            for i in numpy.flatnonzero(~inside):
+                values[i] = findElevation(xc[i], yc[i])
+        return values
+    
+    return cellValues
+
+
+def sampleElevations(coords, demfile, cellValues):
+    """
+    Computes the elevation of a set of coordinates using bilinear 
+    interpolation of the dem cell values
+    
+    :param coords: (N,3) array of x, y, z coordinates in the dem projection
+    :param demfile: DEMFile details of the grid the cells are indexed on
+    :param cellValues: function(xindex, yindex, xcenter, ycenter) returning 
+        the values of the cells; appconfig.NODATA for cells that cannot 
+        be determined, in which case the coordinates keep their existing z
+    :returns: (N,) array of z values
+    """
+    x = coords[:, 0]
+    y = coords[:, 1]
+    z = coords[:, 2].copy()
+    
+    xcellsize = demfile.xcellsize
+    ycellsize = abs(demfile.ycellsize)
+    
+    #find the dem cell containing the point and the neighbouring
+    #cell in the direction of the point from the cell center 
+    xindex, yindex = cellIndex(demfile, x, y)
+    
+    x1 = xindex * xcellsize + demfile.xmin + 0.5 * xcellsize
+    y1 = (demfile.ycnt - yindex - 1) * ycellsize + demfile.ymin + 0.5 * ycellsize
+    
+    xindex2 = numpy.where(x < x1, xindex - 1, xindex + 1)
+    yindex2 = numpy.where(y < y1, yindex + 1, yindex - 1)
+    
+    x2 = xindex2 * xcellsize + demfile.xmin + 0.5 * xcellsize
+    y2 = (demfile.ycnt - yindex2 - 1) * ycellsize + demfile.ymin + 0.5 * ycellsize
+    
+    zx1y1 = cellValues(xindex, yindex, x1, y1)
+    zx2y1 = cellValues(xindex2, yindex, x2, y1)
+    zx2y2 = cellValues(xindex2, yindex2, x2, y2)
+    zx1y2 = cellValues(xindex, yindex2, x1, y2)
+    
+    corners = numpy.stack((zx1y1, zx2y1, zx2y2, zx1y2))
+    
+    #no data for these points; keep the existing value
+    keep = (corners == appconfig.NODATA).any(axis=0)
+    
+    #not enough data to determine
+    missing = ~keep & (corners == demfile.nodata).any(axis=0)
+    
+    #bilinear interpolation of elevation
+    fxy1 = ((x2 - x) / (x2 - x1)) * zx1y1 + ((x - x1) / (x2 - x1)) * zx2y1
+    fxy2 = ((x2 - x) / (x2 - x1)) * zx1y2 + ((x - x1) / (x2 - x1)) * zx2y2
+    fxy = ((y2 - y) / (y2 - y1)) * fxy1 + ((y - y1) / (y2 - y1)) * fxy2
+    
+    compute = ~keep & ~missing
+    z[compute] = fxy[compute]
+    z[missing] = appconfig.NODATA
+    return z
 
 
 def findElevation(x, y):
     #search through all dem files for elevation at that point
     #determine by dropping coordinate into dem; should be centered if all dem's are the same
     #but if not won't worry about it for these purposes
-    for demfile in demfiles:
+    for demfile in demIndex.findFiles(x, y):
         if (demfile.xmin <= x and demfile.xmax >= x and demfile.ymin <= y and demfile.ymax >= y ):
-            #read file
             xindex = floor((x - demfile.xmin) / demfile.xcellsize)
             yindex = demfile.ycnt - floor((y - demfile.ymin) / abs(demfile.ycellsize)) - 1
             
-            memmap_image = tif.memmap(demfile.filename)
-            z = memmap_image[yindex][xindex]
-            del memmap_image
-            return z
+            #points on the maximum edge fall just outside the last cell
+            xindex = min(xindex, demfile.xcnt - 1)
+            yindex = max(yindex, 0)
+            
+            data = demReader.getData(demfile)
+            return data[yindex][xindex]
     
     return appconfig.NODATA    
 
+def processAreas(connection, watershed_id, workers):
+    
+    #process each dem file
+    if (workers > 1):
+        processAreasParallel(connection, watershed_id, False, workers)
+    else:
+        for demfile in demfiles:
+            processArea(demfile, connection, watershed_id)
+
+    #search for any missing coordinates that may require 
+    #multiple dem files to compute
+    #if we have one giant dem file then ignore this
+    if (len(demfiles) > 1):
+        print ("  computing overlap areas")
+        if (workers > 1):
+            processAreasParallel(connection, watershed_id, True, workers)
+        else:
+            for demfile in demfiles:
+                processArea(demfile, connection, watershed_id, True)
+
 #--- main program ---
-def main(demfiles):
+def main(files = None):
+    global demIndex
+    
+    if files is None:
+        files = indexDem()
+    
+    #used for finding elevations in neighbouring files
+    demfiles.clear()
+    demfiles.extend(files)
+    demIndex = DEMIndex(demfiles)
+    
+    workers = demWorkers if demWorkers > 0 else os.cpu_count()
+    if (workers > 1 and 'fork' not in multiprocessing.get_all_start_methods()):
+        #spawned processes re-import appconfig which prompts for credentials
+        print("  WARNING: parallel processing is not supported on this platform; processing dem files sequentially")
+        workers = 1
+    workers = min(workers, len(demfiles))
+    
+    mosaic = None
+    #without any dem files there is nothing to mosaic
+    if (demMosaic and len(demfiles) > 0):
+        mosaic = VirtualMosaic(demIndex)
+        if (not mosaic.isSupported()):
+            print("  WARNING: dem files do not share a projection and grid; processing each dem file separately")
+            mosaic = None
     
     with appconfig.connectdb() as conn:
         
@@ -352,20 +709,15 @@ def main(demfiles):
 
         watershed_id = getWatershedIds(conn)
         
-        #process each dem file
         print("Computing Elevations")
-        for demfile in demfiles:
-            processArea(demfile, conn, watershed_id)
-    
-        #search for any missing coordinates that may require 
-        #multiple dem files to compute
-        #if we have one giant dem file then ignore this
-        if (len(demfiles) > 1):
-            print ("  computing overlap areas")
-            for demfile in demfiles:
-                processArea(demfile, conn, watershed_id, True)
+        if (mosaic is not None):
+            #sample every feature once over all the dem files
+            processMosaic(mosaic, conn, watershed_id)
+        else:
+            processAreas(conn, watershed_id, workers)
 
+    demReader.close()
     print("done")
 
 if __name__ == "__main__":
-    main()     
\ No newline at end of file
+    main()
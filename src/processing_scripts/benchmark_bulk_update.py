@@ -0,0 +1,170 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2023 by Canadian Wildlife Federation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Benchmark for the bulk_update write paths. Generates random barrier
+# passability rows and reports rows/sec for:
+#   * the per row cursor.execute INSERT these writes used to use
+#   * bulk_update.insertRows (execute_values multi-row INSERT pages)
+#   * bulk_update.copyRows (binary COPY)
+#
+# Without a database only the client side work is timed: building the
+# per row and paged INSERT statements (statements are built but not sent)
+# and encoding the binary COPY data. With --dsn the rows are also written
+# to a temporary table, so the times include the database round trips.
+# No configuration file is required.
+#
+# usage: python benchmark_bulk_update.py [--rows 100000] [--dsn "host=... dbname=..."]
+#
+import argparse
+import time
+import uuid
+import random
+import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+
+if __package__:
+    from . import bulk_update
+else:
+    import bulk_update
+
+COLUMNS = [('barrier_id', 'uuid'), ('species_id', 'uuid'), ('passability_status', 'varchar')]
+TEMP_TABLE = "benchmark_bulk_update"
+
+
+class StatementCursor:
+    """
+    Cursor that builds the statements the same way as a database cursor
+    but doesn't send them; used to time the client side work without a
+    database
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def mogrify(self, query, args):
+        if isinstance(query, str):
+            query = query.encode('utf-8')
+        return query % tuple(psycopg2.extensions.adapt(arg).getquoted() for arg in args)
+
+    def execute(self, query, args = None):
+        if args is not None:
+            query = self.mogrify(query, args)
+        self.connection.statements += 1
+        self.connection.size += len(query)
+
+
+class StatementConnection:
+    encoding = 'UTF8'
+
+    def __init__(self):
+        self.statements = 0
+        self.size = 0
+
+    def cursor(self):
+        return StatementCursor(self)
+
+
+def createRows(rowcount, seed):
+    rng = random.Random(seed)
+    species = [uuid.UUID(int=rng.getrandbits(128)) for i in range(3)]
+    return [(uuid.UUID(int=rng.getrandbits(128)), rng.choice(species), rng.choice(['PASSABLE', 'BARRIER', 'UNKNOWN', None]))
+            for i in range(rowcount)]
+
+
+def insertPerRow(connection, table, rows):
+    """
+    The per row INSERT that insertRows replaced
+    """
+    query = f"""
+        INSERT INTO {table} (barrier_id, species_id, passability_status)
+        VALUES(%s, %s, %s);
+    """
+    with connection.cursor() as cursor:
+        for row in rows:
+            cursor.execute(query, row)
+
+
+def encodeOnly(connection, table, rows):
+    for chunk in bulk_update.encodeRows(COLUMNS, rows):
+        connection.size += len(chunk)
+
+
+def timeMethod(name, method, rows, repeat, connect, prepare = None):
+    times = []
+    for i in range(repeat):
+        connection = connect()
+        if prepare is not None:
+            prepare(connection)
+        start = time.perf_counter()
+        method(connection, TEMP_TABLE, rows)
+        times.append(time.perf_counter() - start)
+        if prepare is not None:
+            connection.rollback()
+            connection.close()
+    best = min(times)
+    print(f"  {name:<40} {best:8.3f}s {len(rows) / best:12,.0f} rows/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bulk_update write paths.')
+    parser.add_argument('--rows', type=int, default=100000, help='number of rows to write')
+    parser.add_argument('--pagesize', type=int, default=1000, help='rows per insertRows statement')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs (best is reported)')
+    parser.add_argument('--dsn', type=str, default=None, help='optional libpq connection string; rows are written to a temporary table')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    psycopg2.extras.register_uuid()
+    rows = createRows(args.rows, args.seed)
+    print(f"{args.rows} rows of {', '.join(f'{name} {columntype}' for name, columntype in COLUMNS)}")
+
+    pagedInsert = lambda connection, table, rows: bulk_update.insertRows(
+        connection, table, [name for name, columntype in COLUMNS], rows, pagesize=args.pagesize)
+
+    print("Client side (statements built, not sent)")
+    timeMethod("per row execute", insertPerRow, rows, args.repeat, StatementConnection)
+    timeMethod(f"insertRows (page size {args.pagesize})", pagedInsert, rows, args.repeat, StatementConnection)
+    timeMethod("encodeRows (binary copy data)", encodeOnly, rows, args.repeat, StatementConnection)
+
+    if args.dsn is None:
+        print("Pass --dsn to also time the writes against a database")
+        return
+
+    def createTempTable(connection):
+        columndef = ", ".join(f"{name} {columntype}" for name, columntype in COLUMNS)
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TEMPORARY TABLE {TEMP_TABLE} ({columndef}) ON COMMIT DROP;")
+
+    connect = lambda: psycopg2.connect(args.dsn)
+    copy = lambda connection, table, rows: bulk_update.copyRows(connection, table, COLUMNS, rows)
+
+    print("Database (rows written to a temporary table)")
+    timeMethod("per row execute", insertPerRow, rows, args.repeat, connect, createTempTable)
+    timeMethod(f"insertRows (page size {args.pagesize})", pagedInsert, rows, args.repeat, connect, createTempTable)
+    timeMethod("copyRows (binary copy)", copy, rows, args.repeat, connect, createTempTable)
+
+
+if __name__ == "__main__":
+    main()
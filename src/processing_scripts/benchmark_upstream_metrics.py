@@ -0,0 +1,111 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2023 by Canadian Wildlife Federation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Regression benchmark for the upstream habitat metric accumulation used
+# by compute_barriers_upstream_values. Builds a random synthetic stream
+# network (a tree of edges draining to a single outlet) with habitat flags
+# and barrier counts and times the accumulation. No database or
+# configuration is required.
+#
+# usage: python benchmark_upstream_metrics.py [--edges 100000] [--species 3]
+#
+import argparse
+import time
+import numpy as np
+
+if __package__:
+    from . import upstream_metrics
+else:
+    import upstream_metrics
+
+
+def createNetwork(edgecount, speciescnt, window, seed):
+    """
+    Builds a random tree network. Node 0 is the outlet and edge e flows
+    from node e + 1 to a random node in the previous window nodes, so
+    every node is downstream of all the nodes with a higher index.
+
+    :returns: dictionary of the accumulation arguments
+    """
+    rng = np.random.default_rng(seed)
+
+    fromnode = np.arange(1, edgecount + 1, dtype=np.int64)
+    tonode = fromnode - rng.integers(1, window + 1, edgecount)
+    tonode = np.maximum(tonode, 0)
+    nodecount = edgecount + 1
+
+    #levels and barrier counts are computed from upstream (highest
+    #index) to downstream
+    nodelevels = np.zeros(nodecount, dtype=np.int64)
+    barrier = rng.random((edgecount, speciescnt)) < 0.02
+    upbarriercnt = np.zeros((edgecount, speciescnt), dtype=np.int64)
+    nodebarriercnt = np.zeros((nodecount, speciescnt), dtype=np.int64)
+    for edge in range(edgecount - 1, -1, -1):
+        up = fromnode[edge]
+        down = tonode[edge]
+        nodelevels[down] = max(nodelevels[down], nodelevels[up] + 1)
+        upbarriercnt[edge] = nodebarriercnt[up]
+        nodebarriercnt[down] += upbarriercnt[edge] + barrier[edge]
+
+    length = rng.uniform(10, 1000, edgecount)
+    w_length = length * rng.choice([0.25, 0.75, 1.0], edgecount)
+
+    habitat = {}
+    for key, probability in (('access', 0.8), ('spawn', 0.2), ('rear', 0.3), ('habitat', 0.4)):
+        flags = rng.random((edgecount, speciescnt)) < probability
+        habitat[key] = np.column_stack((flags, flags.any(axis=1)))
+
+    return {
+        'species': [f"s{i}" for i in range(speciescnt)],
+        'fromnode': fromnode,
+        'tonode': tonode,
+        'nodelevels': nodelevels,
+        'length': length,
+        'w_length': w_length,
+        'habitat': habitat,
+        'upbarriercnt': upbarriercnt,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the upstream habitat metric accumulation.')
+    parser.add_argument('--edges', type=int, default=100000, help='number of edges in the synthetic network')
+    parser.add_argument('--species', type=int, default=3, help='number of species')
+    parser.add_argument('--window', type=int, default=50, help='maximum index distance between an edge and its downstream node (controls the network depth)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    print("Building synthetic network")
+    network = createNetwork(args.edges, args.species, args.window, args.seed)
+    print(f"  {args.edges} edges, {args.species} species, {network['nodelevels'].max() + 1} levels")
+
+    print("Accumulating upstream metrics")
+    times = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        values = upstream_metrics.accumulateMetrics(**network)
+        times.append(time.perf_counter() - start)
+
+    print(f"  best {min(times):.3f}s, median {np.median(times):.3f}s over {args.repeat} runs")
+    print(f"  checksum {values.sum():.6e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -21,9 +21,15 @@
 # ASSUMPTION - data is in equal area projection where distance functions return values in metres
 #
 import appconfig
-from imagecodecs.imagecodecs import NONE
 
 import sys
+import numpy
+
+if __package__:
+    from . import stream_network, bulk_update
+else:
+    import stream_network
+    import bulk_update
 
 iniSection = appconfig.args.args[0]
 dataSchema = appconfig.config['DATABASE']['data_schema']
@@ -37,6 +43,7 @@ dbModelledCrossingsTable = appconfig.config['CROSSINGS']['modelled_crossings_tab
 dbCrossingsTable = appconfig.config['CROSSINGS']['crossings_table']
 dbVertexTable = appconfig.config['GRADIENT_PROCESSING']['vertex_gradient_table']
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
+dbRawGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 dbGradientBarrierTable = appconfig.config['BARRIER_PROCESSING']['gradient_barrier_table']
 dbHabAccessUpdates = "habitat_access_updates"
 specCodes = appconfig.config[iniSection]['species']
@@ -45,27 +52,88 @@ specCodes = appconfig.config[iniSection]['species']
 w1 = 0.25
 w2 = 0.75
 
-def insertPassability(conn, passability_data):
+def findGradientBarriers(conn, mingradient):
     """
-    Insert data into the barrier_passability table
+    Finds the vertices where the stream becomes steeper than the minimum
+    gradient. Vertices are ordered by measure along each mainstem and a 
+    barrier is added at the first vertex of each run of steep vertices. 
+    Runs that start at the most downstream vertex of a mainstem are only
+    barriers if one of the streams meeting at that vertex ends at a vertex
+    that is not steep; this is either the outlet of the mainstem itself or
+    the downstream end of the stream the mainstem flows into.
+    
+    :returns: list of (x, y) barrier locations
     """
-    if len(passability_data) == 0:
-        return
-
-    insertquery = f"""
-        INSERT INTO {dbTargetSchema}.barrier_passability (
-            barrier_id
-            ,species_id
-            ,species_code
-            ,passability_status
-        )
-        VALUES(%s, %s, %s, %s);
+    query = f"""    
+        SELECT mainstem_id, st_x(vertex_pnt), st_y(vertex_pnt), gradient
+        FROM {dbTargetSchema}.{dbVertexTable}
+        ORDER BY mainstem_id, downstream_route_measure
     """
-
     with conn.cursor() as cursor:
-        for feature in passability_data:
-            cursor.execute(insertquery, feature)
-    conn.commit()
+        cursor.execute(query)
+        features = cursor.fetchall()
+    
+    if (len(features) == 0):
+        return []
+    
+    mainstems = [feature[0] for feature in features]
+    xy = numpy.array([feature[1:3] for feature in features], dtype=numpy.float64)
+    gradient = numpy.array([feature[3] for feature in features], dtype=numpy.float64)
+    
+    steep = gradient > mingradient
+    newmainstem = numpy.ones(len(features), dtype=bool)
+    newmainstem[1:] = [mainstems[i] != mainstems[i - 1] for i in range(1, len(mainstems))]
+    
+    #start of a run of steep vertices within a mainstem
+    laststeep = numpy.zeros(len(features), dtype=bool)
+    laststeep[1:] = steep[:-1]
+    barrier = steep & ~newmainstem & ~laststeep
+    
+    #steep at the mouth of a mainstem; only a barrier if a stream
+    #meeting at the outlet ends at a vertex that is not steep
+    first = numpy.flatnonzero(steep & newmainstem)
+    if (len(first) > 0):
+        network = stream_network.getNetwork(conn)
+        
+        #vertices that are stream end points are matched 
+        #to the network nodes on their exact location
+        nodeindex = {p: i for i, p in enumerate(map(tuple, network.nodexy.tolist()))}
+        vertexnode = numpy.array([nodeindex.get(p, -1) for p in map(tuple, xy.tolist())], dtype=numpy.int64)
+        
+        flatnode = numpy.zeros(network.nodecount, dtype=bool)
+        flatnode[vertexnode[(vertexnode >= 0) & ~steep]] = True
+        
+        outlets = getMainstemOutlets(conn)
+        for i in first.tolist():
+            outlet = outlets.get(mainstems[i])
+            if outlet is None:
+                continue
+            #the outlet itself and the downstream end of the receiving stream
+            downstream = network.tonode[network.getOutEdges(outlet)]
+            if flatnode[outlet] or flatnode[downstream].any():
+                barrier[i] = True
+    
+    return [tuple(p) for p in xy[barrier].tolist()]
+
+
+def getMainstemOutlets(conn):
+    """
+    Uses the stream network to find the downstream end node 
+    of the most downstream stream on each mainstem
+    
+    :returns: dictionary of mainstem id to outlet node index
+    """
+    network = stream_network.getNetwork(conn)
+    attributes = network.loadAttributes(conn, ["mainstem_id", "downstream_route_measure"])
+    
+    outlets = {}
+    measures = {}
+    for edge, (mainstem, measure) in enumerate(attributes):
+        if mainstem not in measures or measure < measures[mainstem]:
+            measures[mainstem] = measure
+            outlets[mainstem] = int(network.tonode[edge])
+    return outlets
+    
 
 def breakstreams(conn):
         
@@ -130,137 +198,36 @@ def breakstreams(conn):
         mingradient = features[0][0]
         code = features[0][1]
         
-    query = f"""    
-        SELECT mainstem_id, st_Force2d(vertex_pnt), gradient
-        FROM {dbTargetSchema}.{dbVertexTable}
-        ORDER BY mainstem_id, downstream_route_measure
-    """
+    points = findGradientBarriers(conn, mingradient)
+    print("    " + str(len(points)) + " gradient barriers")
+    
+    #gradient barriers are passable for all other species
+    othercols = [f"passability_status_{species}" for species in specCodes if species != code]
+    colString = ''.join(f", {col}" for col in othercols)
+    valueString = ', 1' * len(othercols)
+    
+    staging = bulk_update.loadStaging(conn, [("x", "double precision"), ("y", "double precision")], points)
+    query = f"""
+        INSERT INTO {dbTargetSchema}.{dbGradientBarrierTable} (point, id, type, passability_status_{code}{colString})
+        SELECT st_setsrid(st_makepoint(x, y), {appconfig.dataSrid}), gen_random_uuid(), 'gradient_barrier', 0{valueString}
+        FROM {staging};
+        
+        DROP TABLE {staging};
         
+        -- add gradient barriers to passability table; these are
+        -- barriers for the species with the minimum gradient only
+        INSERT INTO {dbTargetSchema}.barrier_passability (
+            barrier_id
+            ,species_id
+            ,species_code
+            ,passability_status
+        )
+        SELECT b.id, f.id, f.code, CASE WHEN f.code = '{code}' THEN 0 ELSE 1 END
+        FROM {dbTargetSchema}.{dbGradientBarrierTable} b, {dbTargetSchema}.fish_species f
+        WHERE b.id NOT IN (SELECT barrier_id FROM {dbTargetSchema}.barrier_passability);
+    """
     with conn.cursor() as cursor:
         cursor.execute(query)
-        
-        features = cursor.fetchall()
-        
-        lastmainstem = NONE
-        lastgradient = -1
-        
-        for feature in features:
-            mainstem = feature[0]
-            point = feature[1]
-            gradient = feature[2]
-            
-            insert = False
-            if (lastmainstem != mainstem and gradient > mingradient):
-                #we need to find what the gradient is at the downstream point here
-                # and only add this as a break point
-                # if downstream vertex is < 0.15
-                query = f"""
-                
-                    with pnt as (
-                        SELECT st_endpoint(a.geometry) as endpnt
-                        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-                        WHERE st_intersects( a.geometry, '{point}')
-                    )
-                    SELECT gradient
-                    FROM {dbTargetSchema}.{dbVertexTable} a, pnt
-                    WHERE a.vertex_pnt && pnt.endpnt
-                    AND gradient <= {mingradient}
-                """ 
-                #print(query)
-                with conn.cursor() as cursor3:
-                    cursor3.execute(query)
-                    features3 = cursor3.fetchall()
-                    if (len(features3) > 0):
-                        insert = True
-    
-                
-
-            elif (gradient > mingradient) and \
-                not((lastgradient > mingradient and gradient > mingradient and lastmainstem == mainstem)):
-                
-                insert = True
-            
-            if insert:
-                # this is a point that is not the first point on a new mainstem 
-                # has a gradient larger than required values
-                # and has a downstream gradient that is less than required values  
-                query = f"""INSERT INTO {dbTargetSchema}.{dbGradientBarrierTable} (point, id, type, passability_status_{code}) values ('{point}', gen_random_uuid(), 'gradient_barrier', 0);""" 
-                with conn.cursor() as cursor2:
-                    cursor2.execute(query)
-                
-                # set gradient barriers to be passable for all other species
-                for species in specCodes:
-                    if species != code:
-                        foo = species
-                        col = "passability_status_" + foo
-                        query = f"""
-                            UPDATE {dbTargetSchema}.{dbGradientBarrierTable} SET {col} = 1;
-                        """
-                        with conn.cursor() as cursor2:
-                            cursor2.execute(query)
-                    else:
-                        continue
-                    
-            lastmainstem = mainstem
-            lastgradient = gradient
-
-        # add gradient barriers to passability table
-        query = f"""
-            SELECT id
-            FROM {dbTargetSchema}.{dbGradientBarrierTable}
-            WHERE id NOT IN (SELECT barrier_id FROM {dbTargetSchema}.barrier_passability)
-        """
-
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            feature_data = cursor.fetchall()
-        conn.commit()
-
-        query = f"""
-            SELECT id, code
-            FROM {dbTargetSchema}.fish_species
-            WHERE code = '{code}'
-        """ 
-        # print(query)
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            species = cursor.fetchall()
-        conn.commit()
-
-        query = f"""
-            SELECT id, code
-            FROM {dbTargetSchema}.fish_species
-            WHERE code != '{code}'
-        """
-        # print(query)
-        with conn.cursor() as cursor:
-            cursor.execute(query)
-            other_species = cursor.fetchall()
-        conn.commit()
-
-        passability_data = []
-        other_passability_data = [] # barriers passable for all other species
-
-        for feature in feature_data:
-            for s in species:
-                passability_feature = []
-                passability_feature.append(feature[0])
-                passability_feature.append(s[0])
-                passability_feature.append(s[1])
-                passability_feature.append(0)
-                if len(passability_feature) != 0:
-                    passability_data.append(passability_feature)
-            for s in other_species:
-                other_passability_feature = []
-                other_passability_feature.append(feature[0])
-                other_passability_feature.append(s[0])
-                other_passability_feature.append(s[1])
-                other_passability_feature.append(1)
-                if len(other_passability_feature) != 0:
-                    other_passability_data.append(other_passability_feature)
-        
-        insertPassability(conn, passability_data)
-        insertPassability(conn, other_passability_data)
 
     #break streams at snapped points
     #todo: may want to ensure this doesn't create small stream segments - 
@@ -285,19 +252,46 @@ def breakstreams(conn):
             SELECT {appconfig.dbIdField},
                 st_split(st_snap(geometry, rawpnt, 0.001), rawpnt) as geometry
             FROM breakpoints 
+        ),
+        segments as (
+            SELECT z.{appconfig.dbIdField},
+                    y.source_id,
+                    y.{appconfig.dbWatershedIdField},
+                    y.stream_name,
+                    y.strahler_order,
+                    {appconfig.streamTableChannelConfinementField},
+                    {appconfig.streamTableDischargeField},
+                    y.mainstem_id,
+                    st_geometryn(z.geometry, generate_series(1, st_numgeometries(z.geometry))) as geometry
+            FROM newlines z JOIN {dbTargetSchema}.{dbTargetStreamTable} y 
+                 ON y.{appconfig.dbIdField} = z.{appconfig.dbIdField}
+        ),
+        measures as (
+            SELECT s.*,
+                st_linelocatepoint(y.geometry, st_startpoint(s.geometry)) as startfraction,
+                st_linelocatepoint(y.geometry, st_endpoint(s.geometry)) as endfraction,
+                y.{dbRawGeom} as parentraw,
+                y.{dbTargetGeom} as parentsmoothed
+            FROM segments s JOIN {dbTargetSchema}.{dbTargetStreamTable} y 
+                 ON y.{appconfig.dbIdField} = s.{appconfig.dbIdField}
         )
         
-        SELECT z.{appconfig.dbIdField},
-                y.source_id,
-                y.{appconfig.dbWatershedIdField},
-                y.stream_name,
-                y.strahler_order,
-                {appconfig.streamTableChannelConfinementField},
-                {appconfig.streamTableDischargeField},
-                y.mainstem_id,
-                st_geometryn(z.geometry, generate_series(1, st_numgeometries(z.geometry))) as geometry
-        FROM newlines z JOIN {dbTargetSchema}.{dbTargetStreamTable} y 
-             ON y.{appconfig.dbIdField} = z.{appconfig.dbIdField};
+        -- carry the elevations of the parent stream through to the new
+        -- segments; elevations at the break points are interpolated from 
+        -- the parent so the dem does not need to be sampled again
+        SELECT {appconfig.dbIdField}, source_id, {appconfig.dbWatershedIdField}, 
+            stream_name, strahler_order, 
+            {appconfig.streamTableChannelConfinementField}, {appconfig.streamTableDischargeField},
+            mainstem_id, geometry,
+            CASE WHEN startfraction < endfraction 
+                THEN st_linesubstring(parentraw, startfraction, endfraction)
+                ELSE st_force3d(geometry, st_z(st_lineinterpolatepoint(parentraw, startfraction)))
+            END as {dbRawGeom},
+            CASE WHEN startfraction < endfraction 
+                THEN st_linesubstring(parentsmoothed, startfraction, endfraction)
+                ELSE st_force3d(geometry, st_z(st_lineinterpolatepoint(parentsmoothed, startfraction)))
+            END as {dbTargetGeom}
+        FROM measures;
         
         DELETE FROM {dbTargetSchema}.{dbTargetStreamTable} 
         WHERE {appconfig.dbIdField} IN (SELECT {appconfig.dbIdField} FROM {dbTargetSchema}.newstreamlines);
@@ -307,7 +301,7 @@ def breakstreams(conn):
             (id, source_id, {appconfig.dbWatershedIdField}, stream_name, strahler_order, 
             segment_length, w_segment_length,
             {appconfig.streamTableChannelConfinementField},{appconfig.streamTableDischargeField},
-            mainstem_id, geometry)
+            mainstem_id, geometry, {dbRawGeom}, {dbTargetGeom})
         SELECT gen_random_uuid(), a.source_id, a.{appconfig.dbWatershedIdField}, 
             a.stream_name, a.strahler_order,
             st_length2d(a.geometry) / 1000.0, 
@@ -318,7 +312,7 @@ def breakstreams(conn):
             end,
             a.{appconfig.streamTableChannelConfinementField},
             a.{appconfig.streamTableDischargeField}, 
-            mainstem_id, a.geometry
+            mainstem_id, a.geometry, a.{dbRawGeom}, a.{dbTargetGeom}
         FROM {dbTargetSchema}.newstreamlines a;
 
         DELETE FROM {dbTargetSchema}.{dbTargetStreamTable} WHERE ST_IsEmpty(geometry);
@@ -425,6 +419,7 @@ def main():
 
         print("    breaking streams at barrier points")
         breakstreams(connection)
+        stream_network.clearNetwork()
         
         print("    recomputing mainstem measures")
         recomputeMainstreamMeasure(connection)
@@ -0,0 +1,212 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2023 by Canadian Wildlife Federation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Bulk writer for per-feature values. Rows are streamed into a temporary
+# staging table with a binary COPY (temporary tables are not written to
+# the WAL) and the target table is updated with a single UPDATE ... FROM
+# join, instead of executing one UPDATE statement per feature. Rows are
+# encoded in chunks as the COPY reads them so the full payload is never 
+# held in memory.
+#
+# insertRows inserts many rows using multi-row INSERT statements for
+# inserts where the values need sql expressions (geometry construction,
+# text formatting etc.) so cannot be copied directly.
+#
+# Columns are described as (name, type) tuples. Supported types are
+# uuid, geometry (values are wkb bytes), double precision, smallint, integer,
+# bigint, boolean, varchar and text. None values are written as null.
+#
+import struct
+import uuid
+import psycopg2.extras
+
+stagingTable = "bulk_update_staging"
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+
+#approximate number of bytes encoded at a time
+CHUNK_SIZE = 1 << 20
+
+def encodeUuid(value):
+    if not isinstance(value, uuid.UUID):
+        value = uuid.UUID(str(value))
+    return value.bytes
+
+def encodeText(value):
+    return str(value).encode('utf-8')
+
+#binary encoders for the supported column types
+encoders = {
+    'uuid': encodeUuid,
+    'geometry': bytes,
+    'double precision': lambda value: struct.pack('!d', value),
+    'smallint': lambda value: struct.pack('!h', value),
+    'integer': lambda value: struct.pack('!i', value),
+    'bigint': lambda value: struct.pack('!q', value),
+    'boolean': lambda value: struct.pack('!?', value),
+    'varchar': encodeText,
+    'text': encodeText,
+}
+
+
+def encodeRows(columns, rows):
+    """
+    Encodes the rows in the postgresql binary copy format
+    :param columns: list of (name, type) tuples
+    :param rows: iterable of tuples with one value per column
+    :returns: generator of byte chunks containing the copy data
+    """
+    rowencoders = [encoders[columntype] for name, columntype in columns]
+    fieldcount = struct.pack('!h', len(columns))
+    nullvalue = struct.pack('!i', -1)
+
+    chunk = [COPY_HEADER]
+    size = len(COPY_HEADER)
+    for row in rows:
+        chunk.append(fieldcount)
+        for encoder, value in zip(rowencoders, row):
+            if value is None:
+                chunk.append(nullvalue)
+            else:
+                data = encoder(value)
+                chunk.append(struct.pack('!i', len(data)))
+                chunk.append(data)
+                size += len(data)
+        size += 2 + 4 * len(rowencoders)
+        
+        if size >= CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(COPY_TRAILER)
+    yield b''.join(chunk)
+
+
+class CopyStream:
+    """
+    Read only file like object over the encoded copy data; rows are
+    only encoded as the copy reads them so the full copy payload 
+    is never held in memory
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = b''
+        self.position = 0
+
+    def read(self, size = -1):
+        parts = []
+        while size != 0:
+            if self.position >= len(self.chunk):
+                self.chunk = next(self.chunks, b'')
+                self.position = 0
+                if len(self.chunk) == 0:
+                    break
+            
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.position + size)
+            parts.append(self.chunk[self.position:end])
+            if size > 0:
+                size -= end - self.position
+            self.position = end
+        return b''.join(parts)
+
+    def readline(self, size = -1):
+        return self.read(size)
+
+
+def copyRows(connection, table, columns, rows):
+    """
+    Copies the rows into an existing table
+    :param connection: database connection; the changes are not committed
+    :param table: the (schema qualified) table to copy the rows into
+    :param columns: list of (name, type) tuples
+    :param rows: iterable of tuples with one value per column
+    """
+    columnnames = ", ".join(name for name, columntype in columns)
+
+    with connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table} ({columnnames}) FROM STDIN (FORMAT binary)", CopyStream(encodeRows(columns, rows)))
+
+
+def insertRows(connection, table, fields, rows, template = None, pagesize = 1000):
+    """
+    Inserts many rows with multi-row INSERT statements
+    :param connection: database connection; the changes are not committed
+    :param table: the (schema qualified) table to insert into
+    :param fields: list of the table fields being inserted
+    :param rows: list of tuples with one value per template placeholder
+    :param template: optional row template, for example 
+        "(%s, st_setsrid(st_makepoint(%s, %s), 4617), UPPER(%s))";
+        by default one placeholder per field
+    :param pagesize: number of rows per INSERT statement
+    """
+    if len(rows) == 0:
+        return
+    
+    query = f"INSERT INTO {table} ({', '.join(fields)}) VALUES %s"
+    with connection.cursor() as cursor:
+        psycopg2.extras.execute_values(cursor, query, rows, template=template, page_size=pagesize)
+
+
+def loadStaging(connection, columns, rows):
+    """
+    Creates the temporary staging table and copies the rows into it
+    :returns: the name of the staging table
+    """
+    columndef = ", ".join(f"{name} {columntype}" for name, columntype in columns)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {stagingTable}; CREATE TEMPORARY TABLE {stagingTable} ({columndef});")
+    copyRows(connection, stagingTable, columns, rows)
+    with connection.cursor() as cursor:
+        cursor.execute(f"ANALYZE {stagingTable}")
+    return stagingTable
+
+
+def updateTable(connection, table, idfield, columns, rows, assignments = None):
+    """
+    Updates the values of a table for many rows at once
+    :param connection: database connection; the changes are not committed
+    :param table: the (schema qualified) table to update
+    :param idfield: the id field of the table; the first column of each row
+        contains the id of the row to update
+    :param columns: list of (name, type) tuples describing the row values,
+        the first column is the id
+    :param rows: iterable of tuples with one value per column
+    :param assignments: optional dictionary of table field to sql expression;
+        expressions reference the staging values as s.<column name>.
+        By default each column (other than the id) is assigned to the
+        table field with the same name
+    """
+    if assignments is None:
+        assignments = {name: f"s.{name}" for name, columntype in columns[1:]}
+
+    staging = loadStaging(connection, columns, rows)
+    setclause = ", ".join(f"{field} = {expression}" for field, expression in assignments.items())
+
+    query = f"""
+        UPDATE {table} t
+        SET {setclause}
+        FROM {staging} s
+        WHERE t.{idfield} = s.{columns[0][0]};
+
+        DROP TABLE {staging};
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(query)
@@ -34,7 +34,10 @@
 import appconfig
 import psycopg2.extras
 import numpy as np
-import uuid
+import scipy.sparse
+import os
+import multiprocessing
+from multiprocessing import shared_memory
 
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -44,6 +47,13 @@ dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
 dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
 dbPassabilityTable = appconfig.config['BARRIER_PROCESSING']['passability_table']
 specCodes = appconfig.config[iniSection]['species']
+dciMethod = appconfig.config['BARRIER_PROCESSING'].get('dci_method', 'matrix').strip().lower()
+if dciMethod not in ('matrix', 'incremental'):
+    raise ValueError(f"invalid dci_method '{dciMethod}' in BARRIER_PROCESSING; expected matrix or incremental")
+dciWorkers = appconfig.config['BARRIER_PROCESSING'].getint('dci_workers', 1)
+
+#network data used by the worker processes
+workerData = None
 
 class StreamData:
     def __init__(self, fid, length, downbarriers, habitat):
@@ -95,61 +105,257 @@ def getSpeciesConnectivity(conn, species):
 
     return dci_base
 
-def getBarrierDCI(barrier, barrierData, streamData, species, speciesDCI, totalHabitat):
+class DCIData:
     """
-    Docstring for getBarrierDCI
+    Stream segment and barrier data as arrays for computing the barrier dci
+    values incrementally. Barriers and segments are indexed by their position 
+    in the barrier and stream data lists; species by their position in the 
+    species list.
+    
+    For each species the downstream barriers of each segment are stored as a 
+    compressed sparse row (CSR) index (the barriers downstream of segment s are 
+    segbarriers[segptr[s]:segptr[s+1]]) along with the inverted index of the 
+    segments each barrier is downstream of (barsegments[barptr[b]:barptr[b+1]]).
     
-    :param barrier: one barrier in the barrierData list
-    :param barrierData: List of BarrierData objects
-    :param streamData: List of StreamData objects
-    :param species: List of species codes
-    :param speciesDCI: Dict of dci per species for the entire stream network
-    :param totalHabitat: Dict of length of habitat per species over entire stream network
-    :return: dci for barrier
+    The baseline (current) dci of each segment is computed once; the dci of 
+    a barrier only requires re-evaluating the segments it is downstream of.
     """
+    def __init__(self, streamData, barrierData, species, totalHabitat):
+        self.species = species
+        self.barrierids = list(barrierData.keys())
+        barrierindex = {str(bid): i for i, bid in enumerate(self.barrierids)}
+        passability = [[barrierData[bid].passabilitystatus[fish] for fish in species] for bid in self.barrierids]
+        
+        self.segptr = []
+        self.segbarriers = []
+        for fish in species:
+            ptr = np.zeros(len(streamData) + 1, dtype=np.int64)
+            indexes = []
+            for i, stream in enumerate(streamData):
+                downbarriers = stream.downbarriers[fish] or []
+                for bid in dict.fromkeys(str(b) for b in downbarriers):
+                    #barriers without passability data are impassable; 
+                    #these are indexed after the known barriers
+                    if bid not in barrierindex:
+                        barrierindex[bid] = len(passability)
+                        passability.append([0.0] * len(species))
+                    indexes.append(barrierindex[bid])
+                ptr[i + 1] = len(indexes)
+            self.segptr.append(ptr)
+            self.segbarriers.append(np.array(indexes, dtype=np.int64))
+        
+        self.barriercnt = len(passability)
+        self.passability = np.array(passability, dtype=np.float64).reshape(-1, len(species))
+        
+        self.barptr = []
+        self.barsegments = []
+        for k in range(len(species)):
+            segments = np.repeat(np.arange(len(streamData)), np.diff(self.segptr[k]))
+            order = np.argsort(self.segbarriers[k], kind='stable')
+            ptr = np.zeros(self.barriercnt + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.segbarriers[k], minlength=self.barriercnt), out=ptr[1:])
+            self.barptr.append(ptr)
+            self.barsegments.append(segments[order])
+        
+        #weight of each segment is its percent of the total habitat length
+        length = np.array([float(stream.length) for stream in streamData], dtype=np.float64)
+        self.weights = np.zeros((len(streamData), len(species)), dtype=np.float64)
+        for k, fish in enumerate(species):
+            habitat = np.array([bool(stream.habitat[fish]) for stream in streamData], dtype=bool)
+            if totalHabitat[fish]:
+                self.weights[habitat, k] = length[habitat] / float(totalHabitat[fish]) * 100
+        
+        #baseline downstream passability and dci of the network
+        self.downpassability = np.column_stack([self.segmentProducts(k) for k in range(len(species))]).reshape(-1, len(species))
+        self.baseline = (self.weights * self.downpassability).sum(axis=0)
+    
+    def segmentProducts(self, k):
+        """
+        :returns: the product of the passability of the downstream 
+            barriers of each segment for species k
+        """
+        ptr = self.segptr[k]
+        counts = np.diff(ptr)
+        products = np.ones(len(counts), dtype=np.float64)
+        if len(self.segbarriers[k]) > 0:
+            products[counts > 0] = np.multiply.reduceat(self.passability[self.segbarriers[k], k], ptr[:-1][counts > 0])
+        return products
+    
+    def share(self):
+        """
+        Moves the arrays into shared memory blocks so they can be read 
+        by worker processes without being copied
+        :returns: list of the shared memory blocks; these must be released
+            with unshare
+        """
+        blocks = []
+        
+        def shareArray(array):
+            block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+            shared[...] = array
+            blocks.append(block)
+            return shared
+        
+        for name, value in list(vars(self).items()):
+            if isinstance(value, np.ndarray):
+                setattr(self, name, shareArray(value))
+            elif isinstance(value, list) and len(value) > 0 and isinstance(value[0], np.ndarray):
+                setattr(self, name, [shareArray(array) for array in value])
+        return blocks
+    
+    def unshare(self, blocks):
+        """
+        Copies the arrays out of the shared memory blocks and releases the blocks
+        """
+        for name, value in list(vars(self).items()):
+            if isinstance(value, np.ndarray):
+                setattr(self, name, value.copy())
+            elif isinstance(value, list) and len(value) > 0 and isinstance(value[0], np.ndarray):
+                setattr(self, name, [array.copy() for array in value])
+        
+        for block in blocks:
+            block.close()
+            block.unlink()
 
-    newStreamArray = []
-    dci_sum = {}
-
-    # TODO: This loop is not a significant bottleneck, nor is the DCI used that much by the biologists
-    # However, this could probably be improved using dynamic programming. 
-    # The DCI values for every stream segment in the entire network should not need to be recalculated every time we want to get the dci for one barrier
-    # Rather, we should keep a table of each stream segment's dci and populate it initially with the dci of the network
-    # Then, when we want to find the dci for a barrier, we should find only the stream segments with that barrier id as a downbarrier and only recalculate those
-    # Then sum the dci's for the stream network using a combination of the previously calculated dcis and the new dcis
-    for stream in streamData:
-        streamDCI = {}
-        downbarriers = stream.downbarriers
-        downpassability = stream.downpassability
-        newStreamData = StreamData(stream.fid, stream.length, downbarriers, stream.habitat)         # This will store the stream info if barrier were removed
 
-        for fish in species:
-            downbarriers[fish] = stream.downbarriers[fish]
-            passabilities = []
-            
-            for b in downbarriers[fish]:                # passability values for downstream barriers aside from current barrier
-                if str(b) == str(barrier.bid):
-                    pass
-                else:
-                    passabilities.append(barrierData[uuid.UUID(b)].passabilitystatus[fish])
-            
-            downpassability[fish] = np.prod(passabilities)
-            newStreamData.downpassability[fish] = downpassability[fish]
+def getBarrierDCI(data, barrier):
+    """
+    Computes the dci of the network for each species if the barrier 
+    was removed. Only the segments the barrier is downstream of are 
+    re-evaluated; their passability is divided by the barrier passability 
+    (or recomputed without the barrier if it is impassable)
+    
+    :param data: DCIData for the network
+    :param barrier: index of the barrier
+    :return: array of network dci for each species
+    """
+    dci = data.baseline.copy()
+    
+    for k in range(len(data.species)):
+        segments = data.barsegments[k][data.barptr[k][barrier]:data.barptr[k][barrier + 1]]
+        if len(segments) == 0:
+            continue
+        
+        passability = data.passability[barrier, k]
+        current = data.downpassability[segments, k]
+        
+        if passability > 0:
+            updated = current / passability
+        else:
+            updated = np.empty(len(segments), dtype=np.float64)
+            for i, segment in enumerate(segments):
+                downbarriers = data.segbarriers[k][data.segptr[k][segment]:data.segptr[k][segment + 1]]
+                updated[i] = np.prod(data.passability[downbarriers[downbarriers != barrier], k])
+        
+        dci[k] += (data.weights[segments, k] * (updated - current)).sum()
+    
+    return dci
 
-            if newStreamData.habitat[fish]:
-                streamDCI[fish] = ((newStreamData.length / totalHabitat[fish]) * newStreamData.downpassability[fish]) * 100  # DCI calculation for stream segment
-            else:
-                streamDCI[fish] = 0
-            
-            newStreamData.dci[fish] = streamDCI[fish]
-            
-        newStreamArray.append(newStreamData) # list of dci for each stream segment 
+def getBarrierDCIMatrix(data):
+    """
+    Computes the network dci for each species if each barrier was removed 
+    using a sparse (segments x barriers) incidence matrix of the downstream 
+    barriers. The downstream passability of the segments is computed from 
+    the sum of the log passabilities (impassable barriers are counted 
+    separately) and the change in dci for every barrier is a single sparse 
+    matrix product per species.
     
-    for fish in species:
-        dci_sum[fish] = sum(newStream.dci[fish] for newStream in newStreamArray)
-        barrier.dci[fish] = round((dci_sum[fish] - speciesDCI[fish]),4)
+    :param data: DCIData for the network
+    :return: array of network dci with one row per barrier and one column per species
+    """
+    dci = np.zeros((data.barriercnt, len(data.species)), dtype=np.float64)
+    
+    for k in range(len(data.species)):
+        incidence = scipy.sparse.csr_matrix(
+            (np.ones(len(data.segbarriers[k])), data.segbarriers[k], data.segptr[k]), 
+            shape=(len(data.weights), data.barriercnt))
+        
+        passability = data.passability[:, k]
+        impassable = passability == 0
+        
+        #log passability of the passable downstream barriers and number 
+        #of impassable downstream barriers of each segment
+        logsum = incidence @ np.log(np.where(impassable, 1.0, passability))
+        impassablecnt = incidence @ impassable.astype(np.float64)
+        
+        weights = data.weights[:, k]
+        current = weights * data.downpassability[:, k]
+        
+        #passable barriers: the dci of the segments downstream of the 
+        #barrier is divided by the barrier passability
+        scale = np.divide(1.0, passability, out=np.zeros_like(passability), where=~impassable) - 1
+        delta = (incidence.T @ current) * scale
+        
+        #impassable barriers: the segments downstream of only this impassable 
+        #barrier gain the passability of the other downstream barriers
+        gain = incidence.T @ (weights * np.exp(logsum) * (impassablecnt == 1))
+        delta[impassable] = gain[impassable]
+        
+        dci[:, k] = data.baseline[k] + delta
+    
+    return dci
+
+
+def getBarrierDCIWorker(barriers):
+    """
+    Computes the dci for a range of barriers in a worker process 
+    using the shared network data
+    """
+    return barriers, np.array([getBarrierDCI(workerData, i) for i in barriers]).reshape(-1, len(workerData.species))
+
+
+def computeDCIParallel(data, workers):
+    """
+    Computes the barrier dci using a pool of worker processes. The network
+    arrays are placed in shared memory and the barriers are partitioned 
+    into ranges across the workers; results are merged as each range 
+    is completed.
+    """
+    global workerData
+    
+    dci = np.zeros((len(data.barrierids), len(data.species)), dtype=np.float64)
+    tasks = [range(chunk[0], chunk[-1] + 1) for chunk in np.array_split(np.arange(len(data.barrierids)), workers * 4) if len(chunk) > 0]
+    
+    blocks = data.share()
+    try:
+        workerData = data
+        context = multiprocessing.get_context('fork')
+        with context.Pool(workers) as pool:
+            for barriers, values in pool.imap_unordered(getBarrierDCIWorker, tasks):
+                dci[barriers.start:barriers.stop] = values
+    finally:
+        workerData = None
+        data.unshare(blocks)
+    
+    return dci
+
+
+def computeDCI(data):
+    """
+    Computes the network dci for each species if each barrier was removed
+    :param data: DCIData for the network
+    :return: array of network dci with one row per barrier (in the order of
+        data.barrierids) and one column per species
+    """
+    if dciMethod == 'matrix':
+        return getBarrierDCIMatrix(data)[:len(data.barrierids)]
+    
+    workers = dciWorkers if dciWorkers > 0 else os.cpu_count()
+    if (workers > 1 and 'fork' not in multiprocessing.get_all_start_methods()):
+        #spawned processes re-import appconfig which prompts for credentials
+        print("  WARNING: parallel processing is not supported on this platform; computing barrier dci sequentially")
+        workers = 1
+    workers = min(workers, len(data.barrierids))
+    
+    if (workers > 1):
+        return computeDCIParallel(data, workers)
+    
+    dci = np.zeros((len(data.barrierids), len(data.species)), dtype=np.float64)
+    for i in range(len(data.barrierids)):
+        dci[i] = getBarrierDCI(data, i)
+    return dci
 
-    return barrier.dci
 
 def getHabitatLength(conn, species):
 
@@ -399,13 +605,18 @@ def main():
 
         barrierData = generateBarrierData(conn, species)
 
+        print("indexing", len(barrierData), "barriers and", len(streamData), "stream segments")
+        data = DCIData(streamData, barrierData, species, totalHabitat)
+
+        print("computing barrier dci")
+        dci = computeDCI(data)
+
         newAllBarrierData = []
 
-        for barrierid in barrierData:
-            print("barrier id:", barrierid, "object:", barrierData[barrierid])
-            dci = getBarrierDCI(barrierData[barrierid], barrierData, streamData, species, speciesDCI, totalHabitat)
+        for i, barrierid in enumerate(data.barrierids):
             newBarrierData = BarrierData(barrierData[barrierid].bid, barrierData[barrierid].passabilitystatus)
-            newBarrierData.dci = dci
+            for k, fish in enumerate(species):
+                newBarrierData.dci[fish] = round(float(dci[i, k]) - speciesDCI[fish], 4)
             newAllBarrierData.append(newBarrierData)
 
         writeResults(conn, newAllBarrierData, species)
@@ -22,11 +22,16 @@
 #
 
 import appconfig
-import shapely.wkb
-from collections import deque
 import psycopg2.extras
 import numpy as np
 
+if __package__:
+    from . import stream_network
+    from . import upstream_metrics
+else:
+    import stream_network
+    import upstream_metrics
+
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
 watershed_id = appconfig.config[iniSection]['watershed_id']
@@ -36,104 +41,99 @@ dbPassabilityTable = appconfig.config['BARRIER_PROCESSING']['passability_table']
 dbBarrierTable = appconfig.config['BARRIER_PROCESSING']['barrier_table']
 species_codes = appconfig.config[iniSection]['species']
 
-edges = []
-nodes = dict()
 species = []
 
-class Node:
+class HabitatEdges:
+    """
+    Per edge attributes and upstream metrics stored as arrays indexed by 
+    the network edge index. Species are indexed in the order of the species
+    list; the species dimension of the habitat flags and metric values has
+    one extra column (the last) for all species combined.
+    """
+    def __init__(self, network, attributes, downpassability):
+        speciescnt = len(species)
+        self.fids = network.fids
+        
+        self.length = np.array([feature[0] for feature in attributes], dtype=np.float64)
+        
+        # weighted length for ranking calculation
+        weights = {1: 0.25, 2: 0.75}
+        self.w_length = self.length * np.array([weights.get(feature[-1], 1.0) for feature in attributes])
+        
+        self.upbarriercnt = np.array([feature[1:1 + speciescnt] for feature in attributes], dtype=np.int64).reshape(-1, speciescnt)
+        self.downpassability = downpassability
+        
+        accessible = (appconfig.Accessibility.ACCESSIBLE.value, appconfig.Accessibility.POTENTIAL.value)
+        access = [[value in accessible for value in feature[1 + speciescnt*2:1 + speciescnt*3]] for feature in attributes]
+        
+        self.habitat = {}
+        self.habitat['access'] = self.withAll(access)
+        for key, index in (('spawn', 3), ('rear', 4), ('habitat', 5)):
+            self.habitat[key] = self.withAll([[bool(value) for value in feature[1 + speciescnt*index:1 + speciescnt*(index + 1)]] for feature in attributes])
+        
+        self.values = None
+        self.dci = None
     
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.barrierids = set()
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
+    def withAll(self, flags):
+        flags = np.array(flags, dtype=bool).reshape(-1, len(species))
+        return np.column_stack((flags, flags.any(axis=1)))
     
-class Edge:
-    def __init__(self, fromnode, tonode, fid, length, strahler_order, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.length = length
-        self.fid = fid
-        self.visited = False
-        self.speca = {} # species accessibility
-        self.specaup = {} # species accessibility upstream
-        self.spawn_habitat = {}
-        self.spawn_habitatup = {}
-        self.rear_habitat = {}
-        self.rear_habitatup = {}
-        self.habitat = {}
-        self.habitatup = {}
-        self.spawn_funchabitatup = {}
-        self.rear_funchabitatup = {}
-        self.funchabitatup = {}
-        self.spawn_habitat_all = None
-        self.spawn_habitatup_all = {}
-        self.rear_habitat_all = None
-        self.rear_habitatup_all = {}
-        self.habitat_all = None
-        self.habitatup_all = {}
-        self.spawn_funchabitat_all = {}
-        self.rear_funchabitat_all = {}
-        self.funchabitat_all = {}
-        self.spawn_funchabitatup_all = {}
-        self.rear_funchabitatup_all = {}
-        self.funchabitatup_all = {}
-
-        self.upbarriercnt = {}
-        self.downbarriers = {}
-        self.downpassability = {}
-        self.dci = {}
 
-        # weighted length for ranking calculation
-        if strahler_order == 1:
-            self.w_length = self.length * 0.25
-        elif strahler_order == 2:
-            self.w_length = self.length * 0.75
-        else:
-            self.w_length = self.length
-
-        # weighted habitat for rankings
-        self.w_habitatup = {}
-        self.w_funchabitatup = {}
+def loadPassability(connection):
+    """
+    Loads the passability of all barriers for all species in a single query
+    :returns: (dictionary of barrier id to row index, matrix of passability 
+        values with one row per barrier and one column per species)
+    """
+    query = f"""
+        SELECT p.barrier_id::varchar, s.code, p.passability_status
+        FROM {dbTargetSchema}.{dbPassabilityTable} p
+        JOIN {dbTargetSchema}.fish_species s
+            ON p.species_id = s.id
+    """
+    
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+    
+    speciesindex = {fish: i for i, fish in enumerate(species)}
+    
+    barrierindex = {}
+    for feature in features:
+        if feature[0] not in barrierindex:
+            barrierindex[feature[0]] = len(barrierindex)
     
-    def print(self):
-        print("fid:", self.fid)
-        print("upbarriercnt:", self.upbarriercnt)
-        print("downbarriers:", self.downbarriers)
-        print("downpassability:", self.downpassability)
-        print("species accessibility:", self.speca)
-        print("spawn_habitat:", self.spawn_habitat)
-        print("rear_habitat:", self.rear_habitat)
-        print("habitat:", self.habitat)
-        print("spawn_habitatup:", self.spawn_habitatup)
-        print("rear_habitatup:", self.rear_habitatup)
-        print("habitatup:", self.habitatup)
-        print("spawn_habitat_all:", self.spawn_habitat_all)
-        print("rear_habitat_all:", self.rear_habitat_all)
-        print("habitat_all:", self.habitat_all)
-
-    def check_spawn_habitat_all(self):
-        result = any(val == True for val in self.spawn_habitat.values())
-        return result
+    #a null passability status is treated as impassable
+    passability = np.zeros((len(barrierindex), len(species)), dtype=np.float64)
+    for bid, code, status in features:
+        if code in speciesindex and status is not None:
+            passability[barrierindex[bid], speciesindex[code]] = float(status)
     
-    def check_rear_habitat_all(self):
-        result = any(val == True for val in self.rear_habitat.values())
-        return result
+    return barrierindex, passability
 
-    def check_habitat_all(self):
-        result = any(val == True for val in self.habitat.values())
-        return result
 
-    def __iter__(self):
-        return iter([self.fid, self.length, self.downbarriers, self.downpassability, self.habitat])
+def computeDownstreamPassability(downbarriers, barrierindex, passability):
+    """
+    Computes the product of the passability of the downstream barriers of 
+    each edge as the exponent of the sum of the log passabilities
+    :param downbarriers: list of downstream barrier ids for each edge
+    :param barrierindex: dictionary of barrier id to passability index
+    :param passability: array of passability values by barrier index
+    :returns: array of downstream passability for each edge
+    """
+    counts = np.array([len(barriers) if barriers else 0 for barriers in downbarriers], dtype=np.int64)
+    #barriers without a passability record are treated as impassable
+    #(the same as a null passability status)
+    values = np.append(passability, 0.0)
+    missing = len(passability)
+    indexes = np.array([barrierindex.get(str(bid), missing) for barriers in downbarriers if barriers for bid in barriers], dtype=np.int64)
+    
+    with np.errstate(divide='ignore'):
+        logs = np.log(values[indexes])
+    
+    logsum = np.bincount(np.repeat(np.arange(len(downbarriers)), counts), weights=logs, minlength=len(downbarriers))
+    return np.exp(logsum)
+
 
 def createNetwork(connection):
 
@@ -153,359 +153,74 @@ def createNetwork(connection):
         WHERE code IN {specCodes};
     """
     
-    barrierupcntmodel = ''
-    barrierdownmodel = ''
-    accessibilitymodel = ''
-    spawnhabitatmodel = ''
-    rearhabitatmodel = ''
-    habitatmodel = ''
+    barrierupcntmodel = []
+    barrierdownmodel = []
+    accessibilitymodel = []
+    spawnhabitatmodel = []
+    rearhabitatmodel = []
+    habitatmodel = []
     with connection.cursor() as cursor:
         cursor.execute(query)
         features = cursor.fetchall()
         for feature in features:
             species.append(feature[0])
-            barrierupcntmodel = barrierupcntmodel + ', barrier_up_' + feature[0] + '_cnt'
-            barrierdownmodel = barrierdownmodel + ', barriers_down_' + feature[0]
-            accessibilitymodel = accessibilitymodel + ', ' + feature[0] + '_accessibility'
-            spawnhabitatmodel = spawnhabitatmodel + ', habitat_spawn_' + feature[0]
-            rearhabitatmodel = rearhabitatmodel + ', habitat_rear_' + feature[0]
-            habitatmodel = habitatmodel + ', habitat_' + feature[0]
+            barrierupcntmodel.append('barrier_up_' + feature[0] + '_cnt')
+            barrierdownmodel.append('barriers_down_' + feature[0])
+            accessibilitymodel.append(feature[0] + '_accessibility')
+            spawnhabitatmodel.append('habitat_spawn_' + feature[0])
+            rearhabitatmodel.append('habitat_rear_' + feature[0])
+            habitatmodel.append('habitat_' + feature[0])
 
     
-    query = f"""
-        SELECT a.{appconfig.dbIdField} as id, 
-            st_length(a.{appconfig.dbGeomField}), a.{appconfig.dbGeomField}
-            {barrierupcntmodel} {barrierdownmodel}
-            {accessibilitymodel} {spawnhabitatmodel} {rearhabitatmodel} {habitatmodel}
-            ,a.strahler_order
-        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-        LEFT JOIN {dbTargetSchema}.{dbBarrierTable} b
-        ON a.id = b.stream_id_up;
-    """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        for feature in features:
-            fid = feature[0]
-            length = feature[1]
-            geom = shapely.wkb.loads(feature[2] , hex=True)
-            strahler_order = feature[-1]
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-
-            edge = Edge(fromNode, toNode, fid, length, strahler_order, geom)
-            index = 3
-            for fish in species:
-                edge.upbarriercnt[fish] = feature[index]
-                edge.downbarriers[fish] = feature[index + len(species)]
-
-                passabilities = []
-
-                for barrier in edge.downbarriers[fish]:
-                    query = f"""
-                    SELECT passability_status 
-                    FROM {dbTargetSchema}.{dbPassabilityTable} p
-                    JOIN {dbTargetSchema}.fish_species s
-                        ON p.species_id = s.id
-                    WHERE p.barrier_id = '{barrier}'
-                    AND s.code = '{fish}'
-                    """
-
-                    with connection.cursor() as cursor2:
-                        cursor2.execute(query)
-                        status = cursor2.fetchone()
-                        val = float(0 if status[0] is None else status[0])
-                        passabilities.append(val)
-                
-                edge.downpassability[fish] = np.prod(passabilities)
-
-                edge.speca[fish] = feature[index + len(species)*2]
-                edge.spawn_habitat[fish] = feature[index + (len(species)*3)]
-                edge.rear_habitat[fish] = feature[index + (len(species)*4)]
-                edge.habitat[fish] = feature[index + (len(species)*5)]
-                index = index + 1
-
-            edge.spawn_habitat_all = edge.check_spawn_habitat_all()
-            edge.rear_habitat_all = edge.check_rear_habitat_all()
-            edge.habitat_all = edge.check_habitat_all()
-
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)
+    network = stream_network.getNetwork(connection)
 
+    fields = [f"st_length({appconfig.dbGeomField})"]
+    fields.extend(barrierupcntmodel + barrierdownmodel + accessibilitymodel
+        + spawnhabitatmodel + rearhabitatmodel + habitatmodel)
+    fields.append("strahler_order")
+
+    attributes = network.loadAttributes(connection, fields)
+    
+    barrierindex, passability = loadPassability(connection)
+    downpassability = np.zeros((network.edgecount, len(species)), dtype=np.float64)
+    for column, fish in enumerate(species):
+        downbarriers = [attributes[i][1 + len(species) + column] for i in range(network.edgecount)]
+        downpassability[:, column] = computeDownstreamPassability(downbarriers, barrierindex, passability[:, column])
 
-def processNodes(connection):
+    return network, HabitatEdges(network, attributes, downpassability)
+
+
+def processNodes(network, edges):
+    """
+    Accumulates the upstream metrics of every edge, species and metric
+    and computes the dci of each habitat edge
+    """
+    edges.values = upstream_metrics.accumulateMetrics(species, 
+        network.fromnode, network.tonode, network.topologicalLevels(), 
+        edges.length, edges.w_length, edges.habitat, edges.upbarriercnt)
     
+    edges.dci = upstream_metrics.computeHabitatDCI(species, 
+        edges.length, edges.habitat['habitat'], edges.downpassability)
     
-    #walk down network        
-    toprocess = deque()
 
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        
-        uplength = {}
-        spawn_habitat = {}
-        rear_habitat = {}
-        habitat = {}
-        spawn_funchabitat = {}
-        rear_funchabitat = {}
-        funchabitat = {}
-        spawn_habitat_all = 0
-        rear_habitat_all = 0
-        habitat_all = 0
-        spawn_funchabitat_all = 0
-        rear_funchabitat_all = 0
-        funchabitat_all = 0
-        outbarriercnt = {}
-        dci = {}
-        total_length = {}
-
-        # weighted
-        w_habitat = {}
-        w_funchabitat = {}
-        
-        for fish in species:
-            uplength[fish] = 0
-            spawn_habitat[fish] = 0
-            rear_habitat[fish] = 0
-            habitat[fish] = 0
-            spawn_funchabitat[fish] = 0
-            rear_funchabitat[fish] = 0
-            funchabitat[fish] = 0
-            outbarriercnt[fish] = 0
-            dci[fish] = 0
-            total_length[fish] = sum(edge.length for edge in edges if edge.habitat[fish])
-            # weighted
-            w_habitat[fish] = 0
-            w_funchabitat[fish] = 0
-
-        for inedge in node.inedges:
-
-            for fish in species:
-                outbarriercnt[fish] += inedge.upbarriercnt[fish]
-
-                if inedge.habitat[fish]:
-                    inedge.dci[fish] = ((inedge.length / total_length[fish]) * inedge.downpassability[fish]) * 100
-                else:
-                    inedge.dci[fish] = 0
-                
-            if not inedge.visited:
-                allvisited = False
-                break
-            else:
-                for fish in species:
-                    uplength[fish] = uplength[fish] + inedge.specaup[fish]
-                    spawn_habitat[fish] = spawn_habitat[fish] + inedge.spawn_habitatup[fish]
-                    rear_habitat[fish] = rear_habitat[fish] + inedge.rear_habitatup[fish]
-                    habitat[fish] = habitat[fish] + inedge.habitatup[fish]
-                    spawn_funchabitat[fish] = spawn_funchabitat[fish] + inedge.spawn_funchabitatup[fish]
-                    rear_funchabitat[fish] = rear_funchabitat[fish] + inedge.rear_funchabitatup[fish]
-                    funchabitat[fish] = funchabitat[fish] + inedge.funchabitatup[fish]
-                    # weighted habitat gain
-                    w_habitat[fish] = w_habitat[fish] + inedge.w_habitatup[fish]
-                    w_funchabitat[fish] = w_funchabitat[fish] + inedge.w_funchabitatup[fish] 
-                
-                spawn_habitat_all = spawn_habitat_all + inedge.spawn_habitatup_all
-                rear_habitat_all = rear_habitat_all + inedge.rear_habitatup_all
-                habitat_all = habitat_all + inedge.habitatup_all
-
-                spawn_funchabitat_all = spawn_funchabitat_all + inedge.spawn_funchabitatup_all
-                rear_funchabitat_all = rear_funchabitat_all + inedge.rear_funchabitatup_all
-                funchabitat_all = funchabitat_all + inedge.funchabitatup_all
-                
-        if not allvisited:
-            toprocess.append(node)
-        else:
-        
-            for outedge in node.outedges:
-
-                for fish in species:
-
-                    if outedge.habitat[fish]:
-                        outedge.dci[fish] = ((outedge.length / total_length[fish]) * outedge.downpassability[fish]) * 100
-                    else:
-                        outedge.dci[fish] = 0
-
-
-                    if (outedge.speca[fish] == appconfig.Accessibility.ACCESSIBLE.value or outedge.speca[fish] == appconfig.Accessibility.POTENTIAL.value):
-                        outedge.specaup[fish] = uplength[fish] + outedge.length
-                    else:
-                        outedge.specaup[fish] = uplength[fish]
-                        
-                    if outedge.spawn_habitat[fish]:
-                        outedge.spawn_habitatup[fish] = spawn_habitat[fish] + outedge.length
-                    else:
-                        outedge.spawn_habitatup[fish] = spawn_habitat[fish]
-                    
-
-                    if outedge.rear_habitat[fish]:
-                        outedge.rear_habitatup[fish] = rear_habitat[fish] + outedge.length
-                    else:
-                        outedge.rear_habitatup[fish] = rear_habitat[fish]
-                    
-
-                    if outedge.habitat[fish]:
-                        outedge.habitatup[fish] = habitat[fish] + outedge.length
-                    else:
-                        outedge.habitatup[fish] = habitat[fish]
-
-
-                    if outedge.upbarriercnt[fish] != outbarriercnt[fish]:
-                        if outedge.spawn_habitat[fish]:
-                            outedge.spawn_funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.spawn_funchabitatup[fish] = 0 
-                    elif outedge.spawn_habitat[fish]:
-                        outedge.spawn_funchabitatup[fish] = spawn_funchabitat[fish] + outedge.length
-                    else:
-                        outedge.spawn_funchabitatup[fish] = spawn_funchabitat[fish]
-
-
-                    if outedge.upbarriercnt[fish] != outbarriercnt[fish]:
-                        if outedge.rear_habitat[fish]:
-                            outedge.rear_funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.rear_funchabitatup[fish] = 0 
-                    elif outedge.rear_habitat[fish]:
-                        outedge.rear_funchabitatup[fish] = rear_funchabitat[fish] + outedge.length
-                    else:
-                        outedge.rear_funchabitatup[fish] = rear_funchabitat[fish]
-
-
-                    if outedge.upbarriercnt[fish] != outbarriercnt[fish]:
-                        if outedge.habitat[fish]:
-                            outedge.funchabitatup[fish] = outedge.length
-                        else:
-                            outedge.funchabitatup[fish] = 0
-                    elif outedge.habitat[fish]:
-                        outedge.funchabitatup[fish] = funchabitat[fish] + outedge.length
-                    else: 
-                        outedge.funchabitatup[fish] = funchabitat[fish]
-
-                    # weighted habitat for ranking
-                    if outedge.habitat[fish]:
-                        outedge.w_habitatup[fish] = w_habitat[fish] + outedge.w_length
-                    else:
-                        outedge.w_habitatup[fish] = w_habitat[fish]
-
-                    if outedge.upbarriercnt[fish] != outbarriercnt[fish]:
-                        if outedge.habitat[fish]:
-                            outedge.w_funchabitatup[fish] = outedge.w_length
-                        else:
-                            outedge.w_funchabitatup[fish] = 0
-                    elif outedge.habitat[fish]:
-                        outedge.w_funchabitatup[fish] = w_funchabitat[fish] + outedge.w_length
-                    else: 
-                        outedge.w_funchabitatup[fish] = w_funchabitat[fish]
-
-                
-                if outedge.spawn_habitat_all:
-                    outedge.spawn_habitatup_all = spawn_habitat_all + outedge.length
-                else:
-                    outedge.spawn_habitatup_all = spawn_habitat_all
-
-                if outedge.rear_habitat_all:
-                    outedge.rear_habitatup_all = rear_habitat_all + outedge.length
-                else:
-                    outedge.rear_habitatup_all = rear_habitat_all
-
-                if outedge.habitat_all:
-                    outedge.habitatup_all = habitat_all + outedge.length
-                else:
-                    outedge.habitatup_all = habitat_all
-                
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.spawn_habitat_all:
-                        outedge.spawn_funchabitatup_all = outedge.length
-                    else:
-                        outedge.spawn_funchabitatup_all = 0
-                elif outedge.spawn_habitat_all:
-                    outedge.spawn_funchabitatup_all = spawn_funchabitat_all + outedge.length
-                else: 
-                    outedge.spawn_funchabitatup_all = spawn_funchabitat_all
-
-
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.rear_habitat_all:
-                        outedge.rear_funchabitatup_all = outedge.length
-                    else:
-                        outedge.rear_funchabitatup_all = 0
-                elif outedge.rear_habitat_all:
-                    outedge.rear_funchabitatup_all = rear_funchabitat_all + outedge.length
-                else: 
-                    outedge.rear_funchabitatup_all = rear_funchabitat_all
-
-
-                if outedge.upbarriercnt != outbarriercnt:
-                    if outedge.habitat_all:
-                        outedge.funchabitatup_all = outedge.length
-                    else:
-                        outedge.funchabitatup_all = 0
-                elif outedge.habitat_all:
-                    outedge.funchabitatup_all = funchabitat_all + outedge.length
-                else: 
-                    outedge.funchabitatup_all = funchabitat_all
-
-
-                outedge.visited = True
-                if (not outedge.toNode in toprocess):
-                    toprocess.append(outedge.toNode)
-        
-def writeResults(connection):
+def writeResults(connection, edges):
+    
+    metricnames = [name for name, weighted, habitat, functional in upstream_metrics.METRICS]
+    allindexes = [metricnames.index(name) for name in upstream_metrics.ALL_METRICS]
       
-    tablestr = ''
-    inserttablestr = ''
-    for fish in species:
-        tablestr = tablestr + ', total_upstr_pot_access_' + fish + ' double precision'
-        tablestr = tablestr + ', total_upstr_hab_spawn_' + fish + ' double precision'
-        tablestr = tablestr + ', total_upstr_hab_rear_' + fish + ' double precision'
-        tablestr = tablestr + ', total_upstr_hab_' + fish + ' double precision'
-        tablestr = tablestr + ', func_upstr_hab_spawn_' + fish + ' double precision'
-        tablestr = tablestr + ', func_upstr_hab_rear_' + fish + ' double precision'
-        tablestr = tablestr + ', func_upstr_hab_' + fish + ' double precision'
-        tablestr = tablestr + ', dci_' + fish + ' double precision'
-        tablestr = tablestr + ', w_total_upstr_hab_' + fish + ' double precision' # weighted habitat
-        tablestr = tablestr + ', w_func_upstr_hab_' + fish + ' double precision' # weighted habitat
-        inserttablestr = inserttablestr + ",%s,%s,%s,%s,%s,%s,%s,%s,%s,%s"
-
-    tablestr = tablestr + ', total_upstr_hab_spawn_all' + ' double precision'
-    tablestr = tablestr + ', total_upstr_hab_rear_all' + ' double precision'
-    tablestr = tablestr + ', total_upstr_hab_all' + ' double precision'
-    tablestr = tablestr + ', func_upstr_hab_spawn_all' + ' double precision'
-    tablestr = tablestr + ', func_upstr_hab_rear_all' + ' double precision'
-    tablestr = tablestr + ', func_upstr_hab_all' + ' double precision'
-    inserttablestr = inserttablestr + ",%s,%s,%s,%s,%s,%s"
+    columns = []
+    blocks = []
+    for index, fish in enumerate(species):
+        columns.extend(f"{name}_{fish}" for name in metricnames)
+        columns.append(f"dci_{fish}")
+        blocks.append(edges.values[:, index, :])
+        blocks.append(edges.dci[:, index:index + 1])
+    
+    columns.extend(f"{name}_all" for name in upstream_metrics.ALL_METRICS)
+    blocks.append(edges.values[:, len(species), allindexes])
+    
+    tablestr = ''.join(f", {column} double precision" for column in columns)
+    inserttablestr = ",%s" * len(columns)
 
     query = f"""
         DROP TABLE IF EXISTS {dbTargetSchema}.temp;
@@ -527,30 +242,8 @@ def writeResults(connection):
 
     newdata = []
     
-    for edge in edges:
-        
-        data = []
-        data.append(edge.fid)
-        for fish in species:
-            data.append (float(edge.specaup[fish]))
-            data.append (float(edge.spawn_habitatup[fish]))
-            data.append (float(edge.rear_habitatup[fish]))
-            data.append (float(edge.habitatup[fish]))
-            data.append (float(edge.spawn_funchabitatup[fish]))
-            data.append (float(edge.rear_funchabitatup[fish]))
-            data.append (float(edge.funchabitatup[fish]))
-            data.append (float(edge.dci[fish]))
-            data.append(edge.w_habitatup[fish]) # weighted habitat
-            data.append(edge.w_funchabitatup[fish]) # weighted habitat
-        
-        data.append(float(edge.spawn_habitatup_all))
-        data.append(float(edge.rear_habitatup_all))
-        data.append(float(edge.habitatup_all))
-        data.append(float(edge.spawn_funchabitatup_all))
-        data.append(float(edge.rear_funchabitatup_all))
-        data.append(float(edge.funchabitatup_all))
-
-        newdata.append( data )
+    for fid, data in zip(edges.fids, np.column_stack(blocks).tolist()):
+        newdata.append( [fid] + data )
 
     with connection.cursor() as cursor:    
         psycopg2.extras.execute_batch(cursor, updatequery, newdata)
@@ -794,8 +487,6 @@ def assignBarrierCounts(connection):
 #--- main program ---
 def main():
 
-    edges.clear()
-    nodes.clear()
     species.clear()    
         
     with appconfig.connectdb() as conn:
@@ -808,13 +499,13 @@ def main():
         assignBarrierCounts(conn)
         
         print("  creating network")
-        createNetwork(conn)
+        network, edges = createNetwork(conn)
         
         print("  processing nodes")
-        processNodes(conn)
+        processNodes(network, edges)
             
         print("  writing results")
-        writeResults(conn)
+        writeResults(conn, edges)
         
     print("done")
     
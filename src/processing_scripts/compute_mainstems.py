@@ -29,11 +29,14 @@
 #  * elevation processing is completed
 #
 import appconfig
-import shapely.wkb
-from collections import deque
 import uuid;
 import psycopg2.extras
 
+if __package__:
+    from . import stream_network
+else:
+    import stream_network
+
 iniSection = appconfig.args.args[0]
 
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -44,7 +47,7 @@ dbMainstemField = appconfig.config['MAINSTEM_PROCESSING']['mainstem_id']
 dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_measure']
 dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
 edges = []
-nodes = dict()
+nodes = []
 
 class Node:
     
@@ -67,12 +70,10 @@ class Node:
    
     
 class Edge:
-    def __init__(self, fromnode, tonode, fid, length, sname, ls):
+    def __init__(self, fromnode, tonode, fid, length, sname):
         self.fromNode = fromnode
         self.toNode = tonode
-        self.ls = ls
         self.fid = fid
-        self.visited = False
         self.length = length
         self.sname = sname
         self.mainstemid = None
@@ -80,102 +81,54 @@ class Edge:
         self.downstreammeasure = 0
         
 def createNetwork(connection):
-    query = f"""
-        SELECT a.{appconfig.dbIdField} as id, st_length(a.{appconfig.dbGeomField}) as length, 
-          a.stream_name, a.{appconfig.dbGeomField}
-        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-    """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
+    
+    network = stream_network.getNetwork(connection)
+    
+    for i in range(network.nodecount):
+        nodes.append(Node(network.nodexy[i][0], network.nodexy[i][1]))
+    
+    attributes = network.loadAttributes(connection, 
+        [f"st_length({appconfig.dbGeomField})", "stream_name"])
+    
+    for i in range(network.edgecount):
+        length = attributes[i][0]
+        sname = attributes[i][1]
+        if (sname == "UNNAMED"):
+            sname = None
         
+        fromNode = nodes[network.fromnode[i]]
+        toNode = nodes[network.tonode[i]]
         
-        for feature in features:
-            fid = feature[0]
-            length = feature[1]
-            sname = feature[2]
-            if (sname == "UNNAMED"):
-                sname = None
-                
-            geom = shapely.wkb.loads(feature[3] , hex=True)
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, length, sname, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)            
+        edge = Edge(fromNode, toNode, network.fids[i], length, sname)
+        edges.append(edge)
+        
+        fromNode.addOutEdge(edge)
+        toNode.addInEdge(edge)            
+    
+    return network
 
-def processNodes():
+def processNodes(network):
     
     
-    #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-            
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
+    #walk down network; upstream nodes are always processed
+    #before the nodes they flow into
+    for n in network.topologicalOrder():
+        node = nodes[n]
         
         maxValue = 0 
         for inedge in node.inedges:
-            if not inedge.visited:
-                allvisited = False;
-                break;
-            else:
-                length = inedge.fromNode.uplength + inedge.length
-                if (length > maxValue):
-                    maxValue = length
+            length = inedge.fromNode.uplength + inedge.length
+            if (length > maxValue):
+                maxValue = length
         
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            node.uplength = maxValue
-            
-        for outedge in node.outedges:
-            outedge.visited = True
-            if (not outedge.toNode in toprocess):
-                toprocess.append(outedge.toNode)
+        node.uplength = maxValue
     
     #walk up computing mainstem id
-    for edge in edges:
-        edge.visited = False
+    for n in network.reverseTopologicalOrder():
+        node = nodes[n]
         
-    toprocess = deque()
-    for node in nodes.values():
         if (len(node.outedges) == 0):
-            toprocess.append(node)
             node.mainstemid = uuid.uuid4()
-    
-    while (toprocess):
-        node = toprocess.popleft()
         
         if (len(node.inedges) == 0):
             continue
@@ -227,8 +180,6 @@ def processNodes():
                 inedge.fromNode.downstreammeasure = inedge.length
 
             inedge.fromNode.mainstemid = inedge.mainstemid
-            
-            toprocess.append(inedge.fromNode)
     
         
 def writeResults(connection):
@@ -283,10 +234,10 @@ def main():
             cursor.execute(query)
         
         print("  creating network")
-        createNetwork(conn)
+        network = createNetwork(conn)
         
         print("  processing nodes")
-        processNodes()
+        processNodes(network)
             
         print("  writing results")
         writeResults(conn)
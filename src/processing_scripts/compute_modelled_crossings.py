@@ -25,6 +25,11 @@ import appconfig
 import sys
 from appconfig import dataSchema
 
+if __package__:
+    from . import bulk_update
+else:
+    import bulk_update
+
 iniSection = appconfig.args.args[0]
 
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -372,18 +377,8 @@ def loadToBarriers(connection):
                 passability_feature.append(0)
             passability_data.append(passability_feature)
 
-    insertquery = f"""
-        INSERT INTO {dbTargetSchema}.{dbPassabilityTable} (
-            barrier_id
-            ,species_id
-            ,passability_status
-        )
-        VALUES(%s, %s, %s);
-    """
-    
-    with connection.cursor() as cursor:
-        for feature in passability_data:
-            cursor.execute(insertquery, feature)
+    bulk_update.insertRows(connection, f"{dbTargetSchema}.{dbPassabilityTable}",
+        ["barrier_id", "species_id", "passability_status"], passability_data)
     connection.commit()
 
 def main():
@@ -19,11 +19,15 @@
 #
 # this script computes upstream/downstream barrier counts and ids
 #
-from collections import deque
-import shapely.wkb
 import psycopg2.extras
 import appconfig
 import sys
+import numpy
+
+if __package__:
+    from . import stream_network
+else:
+    import stream_network
 
 iniSection = appconfig.args.args[0]
 
@@ -37,128 +41,118 @@ dbGradientBarrierTable = appconfig.config['BARRIER_PROCESSING']['gradient_barrie
 dbPassabiltyTable = appconfig.config['BARRIER_PROCESSING']['passability_table']
 snapDistance = appconfig.config['CABD_DATABASE']['snap_distance']
 species = appconfig.config[iniSection]['species']
+singleTraversal = appconfig.config['BARRIER_PROCESSING'].getboolean('updown_single_traversal', True)
 
-edges = []
-nodes = dict()
+#number of bits set in each byte value
+POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.int32)
 
-class Node:
+class BarrierSets:
+    """
+    The sets of barriers upstream and downstream of each node for one or
+    more groups (species). Barriers are mapped to dense integer indexes
+    per group and each set is stored as packed bits; every group has its
+    own byte aligned range of columns so bit i of group g in row n is set 
+    if barrier i is in the set of group g for node n. All groups are 
+    propagated in the same sweep of the network. Barrier ids are only 
+    materialized when writing results.
+    """
+    def __init__(self, groups):
+        self.groups = list(groups)
+        self.ids = {group: [] for group in self.groups}
+        self.index = {group: {} for group in self.groups}
+        self.nodebarriers = {group: [] for group in self.groups}
+        self.offsets = None
+        self.up = None
+        self.down = None
     
-    def __init__(self, x, y):
-        self.inedges = []
-        self.outedges = []
-        self.x = x
-        self.y = y
-        self.barrierids = set()
-        self.gradientbarrierids = set()
-   
-    def addInEdge(self, edge):
-        self.inedges.append(edge)
-   
-    def addOutEdge(self, edge):
-        self.outedges.append(edge)
+    def add(self, group, node, bid):
+        index = self.index[group]
+        if bid not in index:
+            index[bid] = len(self.ids[group])
+            self.ids[group].append(bid)
+        self.nodebarriers[group].append((node, index[bid]))
     
-   
+    def columns(self, group):
+        """
+        :returns: the slice of the packed columns used by the group
+        """
+        return slice(self.offsets[group], self.offsets[group] + max(1, (len(self.ids[group]) + 7) // 8))
     
-class Edge:
-    def __init__(self, fromnode, tonode, fid, ls):
-        self.fromNode = fromnode
-        self.toNode = tonode
-        self.ls = ls
-        self.fid = fid
-        self.visited = False
-        self.upbarriers = set()
-        self.downbarriers = set()
-        self.upgradient = set()
-        self.downgradient = set()
+    def propagate(self, network):
+        """
+        Computes the barriers upstream (including the node) of each node
+        walking down the network and the barriers downstream (including
+        the node) of each node walking up the network
+        """
+        self.offsets = {}
+        nbytes = 0
+        for group in self.groups:
+            self.offsets[group] = nbytes
+            nbytes += max(1, (len(self.ids[group]) + 7) // 8)
+            
+        local = numpy.zeros((network.nodecount, nbytes), dtype=numpy.uint8)
+        for group in self.groups:
+            offset = self.offsets[group]
+            for node, i in self.nodebarriers[group]:
+                local[node, offset + (i >> 3)] |= numpy.uint8(1 << (i & 7))
         
-def createNetwork(connection, code):
-    
-    query = f"""
-        SELECT a.{appconfig.dbIdField} as id, a.{appconfig.dbGeomField}
-        FROM {dbTargetSchema}.{dbTargetStreamTable} a
-    """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
+        fromnode = network.fromnode
+        tonode = network.tonode
         
+        #walk down network; upstream nodes are always processed
+        #before the nodes they flow into
+        self.up = local.copy()
+        for n in network.topologicalOrder():
+            for e in network.getInEdges(n):
+                numpy.bitwise_or(self.up[n], self.up[fromnode[e]], out=self.up[n])
         
-        for feature in features:
-            fid = feature[0]
-            geom = shapely.wkb.loads(feature[1] , hex=True)
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)     
+        #walk up network
+        self.down = local
+        for n in network.reverseTopologicalOrder():
+            for e in network.getOutEdges(n):
+                numpy.bitwise_or(self.down[n], self.down[tonode[e]], out=self.down[n])
+    
+    def counts(self, group, rows):
+        return POPCOUNT[rows[:, self.columns(group)]].sum(axis=1)
+    
+    def members(self, group, row):
+        ids = self.ids[group]
+        return [ids[i] for i in numpy.flatnonzero(numpy.unpackbits(row[self.columns(group)], bitorder='little'))]
+
+
+def loadBarriers(connection, codes):
+    """
+    Loads the barriers (and gradient barriers) that are not passable
+    and the streams they are located at the start or end of, for all 
+    species at once
+    
+    :returns: dictionary of species code to list of 
+        (barrier type, up/down, barrier id, stream id) 
+    """
+    codelist = ", ".join(f"'{code}'" for code in codes)
     
-    #add barriers
     query = f"""
-        select 'up', a.id, b.id
+        select f.code, 'barrier', 'up', a.id, b.id
         from {dbTargetSchema}.{dbBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
         join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
         {dbTargetSchema}.{dbTargetStreamTable} b
         where st_dwithin(b.geometry, a.snapped_point, 0.01)
             and st_dwithin(st_startpoint(b.geometry), a.snapped_point, 0.01)
-            and f.code = '{code}'
+            and f.code in ({codelist})
             and p.passability_status != '1'
         union 
-        select 'down', a.id, b.id 
+        select f.code, 'barrier', 'down', a.id, b.id 
         from {dbTargetSchema}.{dbBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
         join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
         {dbTargetSchema}.{dbTargetStreamTable} b
         where st_dwithin(b.geometry, a.snapped_point, 0.01)
             and st_dwithin(st_endpoint(b.geometry), a.snapped_point, 0.01)
-            and f.code = '{code}'
+            and f.code in ({codelist})
             and p.passability_status != '1'
-    """
-   
-    #load geometries and create a network
-    with connection.cursor() as cursor:
-        cursor.execute(query)
-        features = cursor.fetchall()
-        
-        
-        for feature in features:
-            etype = feature[0]
-            bid = feature[1]
-            sid = feature[2]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    if (etype == 'up'):
-                        edge.fromNode.barrierids.add(bid)
-                    elif (etype == 'down'):
-                        edge.toNode.barrierids.add(bid)
-                        
-    
-    #add gradient barriers
-    query = f"""
-        select 'up', a.id, b.id 
+        union
+        select f.code, 'gradient', 'up', a.id, b.id 
         from {dbTargetSchema}.{dbGradientBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
         join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
@@ -166,10 +160,10 @@ def createNetwork(connection, code):
         where st_dwithin(b.geometry, a.point, 0.01)
             and st_dwithin(st_startpoint(b.geometry), a.point, 0.01)
             and (a.type = 'gradient_barrier' or a.type = 'waterfall')
-            and f.code = '{code}'
+            and f.code in ({codelist})
             and p.passability_status != '1'
         union 
-        select 'down', a.id, b.id 
+        select f.code, 'gradient', 'down', a.id, b.id 
         from {dbTargetSchema}.{dbGradientBarrierTable} a
         join {dbTargetSchema}.{dbPassabiltyTable} p on a.id = p.barrier_id
         join {dbTargetSchema}.fish_species f on p.species_id = f.id, 
@@ -177,115 +171,72 @@ def createNetwork(connection, code):
         where st_dwithin(b.geometry, a.point, 0.01)
             and st_dwithin(st_endpoint(b.geometry), a.point, 0.01)
             and (a.type = 'gradient_barrier' or a.type = 'waterfall')
-            and f.code = '{code}'
+            and f.code in ({codelist})
             and p.passability_status != '1'
     """
-   
-    #load geometries and create a network
+    
+    barriers = {code: [] for code in codes}
     with connection.cursor() as cursor:
         cursor.execute(query)
-        features = cursor.fetchall()
+        for feature in cursor.fetchall():
+            barriers[feature[0]].append(feature[1:])
+    return barriers
         
-        
-        for feature in features:
-            etype = feature[0]
-            bid = feature[1]
-            sid = feature[2]
-            
-            for edge in edges:
-                if (edge.fid == sid):
-                    if (etype == 'up'):
-                        edge.fromNode.gradientbarrierids.add(bid)
-                    elif (etype == 'down'):
-                        edge.toNode.gradientbarrierids.add(bid)         
-
-def processNodes():
+def createNetwork(connection, barriers):
+    """
+    Creates the barrier sets for the network
+    :param barriers: dictionary of species code to the list of barriers 
+        (as returned by loadBarriers); each species is a group of the 
+        barrier sets
+    """
+    network = stream_network.getNetwork(connection)
     
+    barriersets = BarrierSets(barriers.keys())
+    gradientsets = BarrierSets(barriers.keys())
     
-    #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
+    #add barriers; edges are found by id using the network index
+    for code, codebarriers in barriers.items():
+        for btype, etype, bid, sid in codebarriers:
+            edge = network.fidindex[sid]
+            node = network.fromnode[edge] if etype == 'up' else network.tonode[edge]
             
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        allvisited = True
-        
-        upbarriers = set()
-        upgradient = set()
-         
-        for inedge in node.inedges:
-               
-            if not inedge.visited:
-                allvisited = False
-                break
+            if (btype == 'barrier'):
+                barriersets.add(code, node, bid)
             else:
-                upbarriers.update(inedge.upbarriers)
-                upgradient.update(inedge.upgradient)
-                
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            upbarriers.update(node.barrierids)
-            upgradient.update(node.gradientbarrierids)
-        
-            for outedge in node.outedges:
-                outedge.upbarriers.update(upbarriers)
-                outedge.upgradient.update(upgradient)
-                
-                outedge.visited = True
-                if (not outedge.toNode in toprocess):
-                    toprocess.append(outedge.toNode)
-            
-            
-    #walk up computing mainstem id
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
-        if (len(node.outedges) == 0):
-            toprocess.append(node)
+                gradientsets.add(code, node, bid)
     
-    while (toprocess):
-        node = toprocess.popleft()
-        
-        if (len(node.inedges) == 0):
-            continue
-        
-        downbarriers = set()
-        downbarriers.update(node.barrierids)
+    return network, barriersets, gradientsets
 
-        downgradient = set()
-        downgradient.update(node.gradientbarrierids)
-        
-        allvisited = True
+def processNodes(network, barriersets, gradientsets):
+    
+    barriersets.propagate(network)
+    gradientsets.propagate(network)
+    
+def createColumns(connection, code):
+    
+    query = f"""
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barrier_up_{code}_cnt;
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barrier_down_{code}_cnt;
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barriers_up_{code};
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barriers_down_{code};
+
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS gradient_barrier_up_{code}_cnt;
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS gradient_barrier_down_{code}_cnt;
         
-        for outedge in node.outedges:
-            if not outedge.visited:
-                allvisited = False
-                break
-            else:
-                downbarriers.update(outedge.downbarriers)
-                downgradient.update(outedge.downgradient)
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN barrier_up_{code}_cnt int;
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN barrier_down_{code}_cnt int;
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN barriers_up_{code} varchar[];
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN barriers_down_{code} varchar[];
 
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            for inedge in node.inedges:
-                inedge.downbarriers.update(downbarriers)
-                inedge.downgradient.update(downgradient)             
-                inedge.visited = True
-                if (not inedge.toNode in toprocess):
-                    toprocess.append(inedge.fromNode)
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN gradient_barrier_up_{code}_cnt int;
+        ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN gradient_barrier_down_{code}_cnt int;
+        
+    """
     
+    with connection.cursor() as cursor:
+        cursor.execute(query)
         
-def writeResults(connection, code):
+def writeResults(connection, code, network, barriersets, gradientsets):
       
     updatequery = f"""
         UPDATE {dbTargetSchema}.{dbTargetStreamTable} SET 
@@ -299,13 +250,23 @@ def writeResults(connection, code):
         WHERE id = %s;
     """
     
+    #the barriers upstream of an edge are those upstream of its from node 
+    #and the barriers downstream of an edge are those downstream of its to node
+    fromnode = network.fromnode
+    tonode = network.tonode
+    
+    upcnt = barriersets.counts(code, barriersets.up[fromnode]).tolist()
+    downcnt = barriersets.counts(code, barriersets.down[tonode]).tolist()
+    gradientupcnt = gradientsets.counts(code, gradientsets.up[fromnode]).tolist()
+    gradientdowncnt = gradientsets.counts(code, gradientsets.down[tonode]).tolist()
+    
     newdata = []
     
-    for edge in edges:
-        upbarriersstr = (list(edge.upbarriers),)  
-        downbarriersstr = (list(edge.downbarriers),)
+    for i in range(network.edgecount):
+        upbarriersstr = (barriersets.members(code, barriersets.up[fromnode[i]]),)  
+        downbarriersstr = (barriersets.members(code, barriersets.down[tonode[i]]),)
         
-        newdata.append( (len(edge.upbarriers), len(edge.downbarriers), upbarriersstr, downbarriersstr, len(edge.upgradient), len(edge.downgradient), edge.fid))
+        newdata.append( (upcnt[i], downcnt[i], upbarriersstr, downbarriersstr, gradientupcnt[i], gradientdowncnt[i], network.fids[i]))
 
     
     with connection.cursor() as cursor:    
@@ -323,49 +284,39 @@ def main():
         global species
 
         specCodes = [substring.strip() for substring in species.split(',')]
+        
+        print("Computing Upstream/Downstream Barriers")
+        print("  loading barriers")
+        barriers = loadBarriers(conn, specCodes)
 
-        for species in specCodes:
-            code = species
-
-            edges.clear()
-            nodes.clear()
-            
-            print("Computing Upstream/Downstream Barriers")
-            print("  processing barriers for", code)
-            print("  creating output column")
-
-            query = f"""
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barrier_up_{code}_cnt;
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barrier_down_{code}_cnt;
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barriers_up_{code};
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS barriers_down_{code};
-
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS gradient_barrier_up_{code}_cnt;
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} DROP COLUMN IF EXISTS gradient_barrier_down_{code}_cnt;
-                
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN barrier_up_{code}_cnt int;
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN barrier_down_{code}_cnt int;
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN barriers_up_{code} varchar[];
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN barriers_down_{code} varchar[];
-
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN gradient_barrier_up_{code}_cnt int;
-                ALTER TABLE {dbTargetSchema}.{dbTargetStreamTable} ADD COLUMN gradient_barrier_down_{code}_cnt int;
-                
-            """
-            
-            with conn.cursor() as cursor:
-                cursor.execute(query)
-            
+        if singleTraversal:
+            #all species are propagated in the same sweep of the network
             print("  creating network")
-            createNetwork(conn, code)
+            network, barriersets, gradientsets = createNetwork(conn, barriers)
             
             print("  processing nodes")
-            processNodes()
+            processNodes(network, barriersets, gradientsets)
+            
+            for code in specCodes:
+                print("  writing results for", code)
+                createColumns(conn, code)
+                writeResults(conn, code, network, barriersets, gradientsets)
+        else:
+            for code in specCodes:
+                print("  processing barriers for", code)
+                print("  creating output column")
+                createColumns(conn, code)
+                
+                print("  creating network")
+                network, barriersets, gradientsets = createNetwork(conn, {code: barriers[code]})
                 
-            print("  writing results")
-            writeResults(conn, code)
+                print("  processing nodes")
+                processNodes(network, barriersets, gradientsets)
+                    
+                print("  writing results")
+                writeResults(conn, code, network, barriersets, gradientsets)
         
     print("done")
     
 if __name__ == "__main__":
-    main()      
\ No newline at end of file
+    main()
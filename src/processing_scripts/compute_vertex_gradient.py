@@ -25,6 +25,13 @@
 # maximum vertex gradient for the stream segment
 #
 import appconfig
+import numpy
+import shapely
+
+if __package__:
+    from . import bulk_update
+else:
+    import bulk_update
 
 iniSection = appconfig.args.args[0]
 
@@ -38,76 +45,243 @@ dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measu
 db3dGeomField = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
 
 dbVertexTable = appconfig.config['GRADIENT_PROCESSING']['vertex_gradient_table']
-dbDownMeasureField = appconfig.config['MAINSTEM_PROCESSING']['downstream_route_measure']
-dbUpMeasureField = appconfig.config['MAINSTEM_PROCESSING']['upstream_route_measure']
 
-db4dGeomField = "geometryzm"
- 
-def setupGeometry(connection):
+#distances upstream (m) of the elevations used to compute the vertex 
+#gradients; the first window is written to the gradient, elevation_b,
+#upstream_pnt and grade_class fields and each additional window is 
+#written to gradient_<window> and grade_class_<window> fields
+gradientWindows = [int(w) for w in appconfig.config['GRADIENT_PROCESSING'].get('gradient_windows', '100').split(',')]
+gradientDistance = gradientWindows[0]
+
+#lower bound (percent) of each grade class; gradients below the 
+#first bound are assigned a grade class of 0
+gradeClasses = [0] + [int(c) for c in appconfig.config['GRADIENT_PROCESSING'].get('grade_class_breaks', '5,7,10,12,15,20,25,30').split(',')]
+gradeClassBreaks = [c / 100.0 for c in gradeClasses[1:]]
+
+class Mainstem:
+    """
+    The vertices of all the streams on a mainstem held in flat arrays
+    ordered by route measure (downstream to upstream)
+    """
+    def __init__(self, mainstemid):
+        self.mainstemid = mainstemid
+        self.segments = []
     
-    # update geometry column    
-    query = f"""
-        alter table {dbTargetSchema}.{dbTargetStreamTable} 
-        add column if not exists {db4dGeomField} geometry(LinestringZM, {appconfig.dataSrid});
+    def addSegment(self, downmeasure, upmeasure, coords):
+        self.segments.append((downmeasure, upmeasure, coords))
+    
+    def build(self):
+        self.segments.sort(key=lambda segment: segment[0])
+        
+        self.downs = numpy.array([segment[0] for segment in self.segments], dtype=numpy.float64)
+        self.ups = numpy.array([segment[1] for segment in self.segments], dtype=numpy.float64)
+        
+        measures = []
+        vertexmask = []
+        for downmeasure, upmeasure, coords in self.segments:
+            #streams are digitized from upstream to downstream; the
+            #route measure of a vertex is the distance to the downstream 
+            #end of the stream plus the stream downstream route measure
+            length = numpy.concatenate(([0], numpy.cumsum(numpy.hypot(numpy.diff(coords[:, 0]), numpy.diff(coords[:, 1])))))
+            measures.append(length[-1] - length + downmeasure)
+            
+            #the downstream end point of each stream is not a gradient vertex
+            mask = numpy.ones(len(coords), dtype=bool)
+            mask[-1] = False
+            vertexmask.append(mask)
         
-        update {dbTargetSchema}.{dbTargetStreamTable} 
-        set {db4dGeomField} = st_addmeasure({db3dGeomField}, st_length({db3dGeomField}), 0) 
+        #reverse each stream so measures increase within each stream
+        self.offsets = numpy.cumsum([0] + [len(segment[2]) for segment in self.segments])
+        self.measures = numpy.concatenate([m[::-1] for m in measures])
+        self.lengths = numpy.array([m[0] - m[-1] for m in measures], dtype=numpy.float64)
+        
+        #search keys; the stream index plus the position of the vertex 
+        #along the stream so keys are always increasing along the mainstem
+        segment = numpy.repeat(numpy.arange(len(self.downs)), numpy.diff(self.offsets))
+        self.keys = segment + self.position(segment, self.measures)
+        self.coords = numpy.concatenate([segment[2][::-1] for segment in self.segments])
+        self.vertexmask = numpy.concatenate([m[::-1] for m in vertexmask])
+        self.segments = None
+    
+    def position(self, segment, measures):
+        """
+        :returns: the position of the measures along the streams 
+            as a fraction of the stream length
+        """
+        lengths = self.lengths[segment]
+        return numpy.divide(measures - self.downs[segment], lengths, out=numpy.zeros(len(measures)), where=lengths > 0)
+    
+    def locate(self, measures):
+        """
+        Interpolates the location and elevation at each route measure 
+        along the mainstem using a binary search on the vertex measures
+        
+        :returns: mask of measures located on the mainstem, and the 
+            (N,3) x,y,z coordinates and (N,) measure along the stream 
+            of the located measures 
+        """
+        segment = numpy.searchsorted(self.downs, measures, side='right') - 1
+        found = segment >= 0
+        found[found] = measures[found] < self.ups[segment[found]]
+        
+        segment = segment[found]
+        measures = measures[found]
+        
+        #vertex on or below the measure within the stream
+        vertex = numpy.searchsorted(self.keys, segment + self.position(segment, measures), side='right') - 1
+        vertex = numpy.clip(vertex, self.offsets[segment], self.offsets[segment + 1] - 2)
+        
+        m1 = self.measures[vertex]
+        m2 = self.measures[vertex + 1]
+        distance = m2 - m1
+        fraction = numpy.divide(measures - m1, distance, out=numpy.zeros(len(measures)), where=distance > 0)
+        
+        c1 = self.coords[vertex]
+        c2 = self.coords[vertex + 1]
+        located = c1 + (c2 - c1) * fraction[:, numpy.newaxis]
+        
+        return found, located, measures - self.downs[segment]
+
+
+def loadMainstems(connection):
+    
+    query = f"""
+        SELECT {dbMainstemField}, {dbDownMeasureField}, {dbUpMeasureField}, {db3dGeomField}
+        FROM {dbTargetSchema}.{dbTargetStreamTable}
+        WHERE {db3dGeomField} IS NOT NULL
     """
     
     with connection.cursor() as cursor:
-        cursor.execute(query)    
-            
-    connection.commit()
+        cursor.execute(query)
+        features = cursor.fetchall()
+    
+    geoms = shapely.from_wkb([feature[3] for feature in features])
+    
+    mainstems = {}
+    for feature, geom in zip(features, geoms):
+        mainstem = mainstems.get(feature[0])
+        if mainstem is None:
+            mainstem = Mainstem(feature[0])
+            mainstems[feature[0]] = mainstem
+        mainstem.addSegment(feature[1], feature[2], shapely.get_coordinates(geom, include_z=True))
+    
+    for mainstem in mainstems.values():
+        mainstem.build()
+    
+    return mainstems
 
-def computeVertexGradients(connection):
 
+def gradeClass(gradient):
+    return numpy.asarray(gradeClasses)[numpy.digitize(gradient, gradeClassBreaks)]
+
+
+def computeGradients(mainstem):
+    """
+    Computes the gradient between each vertex and the point each
+    gradient window upstream along the mainstem. All windows are 
+    computed from the same measure ordered vertex arrays.
+    
+    :returns: list of vertex_gradient rows
+    """
+    vertices = numpy.flatnonzero(mainstem.vertexmask)
+    measures = mainstem.measures[vertices]
+    
+    found, upstream, upstreammeasure = mainstem.locate(measures + gradientDistance)
+    vertices = vertices[found]
+    measures = measures[found]
+    
+    vertex = mainstem.coords[vertices]
+    gradient = (upstream[:, 2] - vertex[:, 2]) / gradientDistance
+    gradeclass = gradeClass(gradient)
+    
+    #vertex measure along its own stream
+    segment = numpy.searchsorted(mainstem.offsets, vertices, side='right') - 1
+    vertexmeasure = measures - mainstem.downs[segment]
+    
+    keep = (vertex[:, 2] != appconfig.NODATA) & (upstream[:, 2] != appconfig.NODATA)
+    
+    #additional windows; vertices without an upstream elevation 
+    #for a window have a null gradient
+    windowvalues = []
+    for window in gradientWindows[1:]:
+        wfound, wupstream, wmeasure = mainstem.locate(measures + window)
+        
+        wgradient = numpy.full(len(measures), numpy.nan)
+        wgradient[wfound] = (wupstream[:, 2] - vertex[wfound, 2]) / window
+        wgradient[wfound & (vertex[:, 2] == appconfig.NODATA)] = numpy.nan
+        wgradient[numpy.flatnonzero(wfound)[wupstream[:, 2] == appconfig.NODATA]] = numpy.nan
+        
+        wclass = gradeClass(wgradient)
+        windowvalues.append([(None, None) if numpy.isnan(g) else (g, int(c)) for g, c in zip(wgradient.tolist(), wclass.tolist())])
+    
+    rows = []
+    for i in numpy.flatnonzero(keep).tolist():
+        row = (mainstem.mainstemid, measures[i], vertex[i, 2], upstream[i, 2], gradient[i],
+            vertex[i, 0], vertex[i, 1], vertexmeasure[i], 
+            upstream[i, 0], upstream[i, 1], upstreammeasure[i], int(gradeclass[i]))
+        for values in windowvalues:
+            row = row + values[i]
+        rows.append(row)
+    return rows
+    
+
+def computeVertexGradients(connection):
+    
+    mainstems = loadMainstems(connection)
+    
+    rows = []
+    for mainstem in mainstems.values():
+        rows.extend(computeGradients(mainstem))
+    
+    columns = [
+        (dbMainstemField, "uuid"),
+        ("downstream_route_measure", "double precision"),
+        ("elevation_a", "double precision"),
+        ("elevation_b", "double precision"),
+        ("gradient", "double precision"),
+        ("vertex_x", "double precision"),
+        ("vertex_y", "double precision"),
+        ("vertex_m", "double precision"),
+        ("upstream_x", "double precision"),
+        ("upstream_y", "double precision"),
+        ("upstream_m", "double precision"),
+        ("grade_class", "smallint"),
+    ]
+    windowfields = ""
+    windowcolumns = ""
+    for window in gradientWindows[1:]:
+        columns.append((f"gradient_{window}", "double precision"))
+        columns.append((f"grade_class_{window}", "smallint"))
+        windowfields += f", gradient_{window}, grade_class_{window}"
+        windowcolumns += f", gradient_{window} double precision, grade_class_{window} smallint"
+    
+    staging = bulk_update.loadStaging(connection, columns, rows)
+    
     query = f"""
         DROP TABLE IF EXISTS {dbTargetSchema}.{dbVertexTable};
          
-        CREATE TABLE {dbTargetSchema}.{dbVertexTable} AS 
-        SELECT
-            sv.{dbMainstemField},
-            sv.{dbDownMeasureField} as downstream_route_measure,
-            sv.elevation as elevation_a,
-            st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ))).geom) as elevation_b,
-            (st_z((st_dump(ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ))).geom) - sv.elevation) / 100 as gradient,
-            sv.pnt as vertex_pnt,
-            ST_LocateAlong(s2.{db4dGeomField}, (sv.{dbDownMeasureField} + 100) - s2.{dbDownMeasureField} ) as upstream_pnt    
-        FROM (
-           SELECT
-            s.{dbMainstemField},
-            (((1.0 - ST_LineLocatePoint(s.{db4dGeomField}, ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1)))) * st_length(s.{db4dGeomField})) + s.downstream_route_measure) as downstream_route_measure,
-            ST_Z(ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1))) AS elevation,
-            ST_PointN(s.{db4dGeomField}, generate_series(1, ST_NPoints(s.{db4dGeomField}) - 1)) as pnt
-            FROM {dbTargetSchema}.{dbTargetStreamTable} s
-            ORDER BY {dbMainstemField}, {dbDownMeasureField}
-        ) as sv
-        INNER JOIN {dbTargetSchema}.{dbTargetStreamTable} s2 ON sv.{dbMainstemField} = s2.{dbMainstemField} 
-          AND sv.{dbDownMeasureField} + 100 >= s2.{dbDownMeasureField} 
-          AND sv.{dbDownMeasureField} + 100 < s2.{dbUpMeasureField};
+        CREATE TABLE {dbTargetSchema}.{dbVertexTable} (
+            {dbMainstemField} uuid,
+            downstream_route_measure double precision,
+            elevation_a double precision,
+            elevation_b double precision,
+            gradient double precision,
+            vertex_pnt geometry(PointZM, {appconfig.dataSrid}),
+            upstream_pnt geometry(MultiPointZM, {appconfig.dataSrid}),
+            grade_class smallint{windowcolumns}
+        );
 
         ALTER TABLE {dbTargetSchema}.{dbVertexTable} OWNER TO cwf_analyst;
-          
-        DELETE FROM {dbTargetSchema}.{dbVertexTable} WHERE elevation_a = -999999 or elevation_b = -999999;
-        
-        ALTER TABLE {dbTargetSchema}.{dbVertexTable} ADD COLUMN grade_class smallint;
-        
-        UPDATE {dbTargetSchema}.{dbVertexTable} set grade_class = 
-          CASE
-              WHEN gradient >= .05 AND gradient < .07 THEN 5
-              WHEN gradient >= .07 AND gradient < .10 THEN 7
-              WHEN gradient >= .10 AND gradient < .12 THEN 10
-              WHEN gradient >= .12 AND gradient < .15 THEN 12
-              WHEN gradient >= .15 AND gradient < .20 THEN 15
-              WHEN gradient >= .20 AND gradient < .25 THEN 20
-              WHEN gradient >= .25 AND gradient < .30 THEN 25
-              WHEN gradient >= .30 THEN 30
-              ELSE 0
-        END;
-
-        
-        alter table {dbTargetSchema}.{dbTargetStreamTable} 
-        drop column {db4dGeomField};
+        
+        INSERT INTO {dbTargetSchema}.{dbVertexTable} 
+        SELECT {dbMainstemField}, downstream_route_measure, 
+            elevation_a, elevation_b, gradient,
+            st_setsrid(st_makepoint(vertex_x, vertex_y, elevation_a, vertex_m), {appconfig.dataSrid}),
+            st_multi(st_setsrid(st_makepoint(upstream_x, upstream_y, elevation_b, upstream_m), {appconfig.dataSrid})),
+            grade_class{windowfields}
+        FROM {staging};
+        
+        DROP TABLE {staging};
     """
     
     #print (query)
@@ -126,9 +300,6 @@ def main():
         conn.autocommit = False
         
         print("Computing Gradient")
-        print("  setting up tables")
-        setupGeometry(conn)
-        
         print("  computing vertex gradients")
         computeVertexGradients(conn)
         
@@ -26,6 +26,11 @@ import appconfig
 from appconfig import dataSchema
 import ast
 
+if __package__:
+    from . import bulk_update
+else:
+    import bulk_update
+
 iniSection = appconfig.args.args[0]
 
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -238,20 +243,10 @@ def getCABD(conn):
         output_feature.append(feature["properties"]["passability_status"])
         output_data.append(output_feature)
 
-    insertquery = f"""
-        INSERT INTO {dbTargetSchema}.{dbBarrierTable} (
-            cabd_id, 
-            original_point,
-            name,
-            owner,
-            dam_use,
-            passability_status,
-            type)
-        VALUES (%s, ST_Transform(ST_GeomFromText('POINT(%s %s)',4617),{appconfig.dataSrid}), %s, %s, %s, UPPER(%s), 'dam');
-    """
-    with conn.cursor() as cursor:
-        for feature in output_data:
-            cursor.execute(insertquery, feature)
+    bulk_update.insertRows(conn, f"{dbTargetSchema}.{dbBarrierTable}",
+        ["cabd_id", "original_point", "name", "owner", "dam_use", "passability_status", "type"],
+        output_data,
+        f"(%s, ST_Transform(ST_SetSRID(ST_MakePoint(%s, %s), 4617), {appconfig.dataSrid}), %s, %s, %s, UPPER(%s), 'dam')")
     conn.commit()
 
     # retrieve waterfall data from CABD API
@@ -273,23 +268,14 @@ def getCABD(conn):
         output_data.append(output_feature)
 
 
-    insertquery = f"""
-        INSERT INTO {dbTargetSchema}.{dbBarrierTable} (
-            cabd_id, 
-            original_point,
-            name,
-            fall_height_m,
-            passability_status,
-            type)
-        VALUES (%s, ST_Transform(ST_GeomFromText('POINT(%s %s)',4617),{appconfig.dataSrid}), %s,%s, UPPER(%s), 'waterfall');
-    """
-    with conn.cursor() as cursor:
-        for feature in output_data:
-            cursor.execute(insertquery, feature)
+    bulk_update.insertRows(conn, f"{dbTargetSchema}.{dbBarrierTable}",
+        ["cabd_id", "original_point", "name", "fall_height_m", "passability_status", "type"],
+        output_data,
+        f"(%s, ST_Transform(ST_SetSRID(ST_MakePoint(%s, %s), 4617), {appconfig.dataSrid}), %s, %s, UPPER(%s), 'waterfall')")
     conn.commit()
 
-    # insert into waterfalls table 
-    insertquery = f"""
+    # insert into waterfalls table using the same ids as the barriers table
+    query = f"""
         INSERT INTO {dbTargetSchema}.{dbWaterfallTable} (
             id,
             cabd_id, 
@@ -298,11 +284,12 @@ def getCABD(conn):
             fall_height_m,
             passability_status
         )
-        VALUES (%s, %s, ST_Transform(ST_GeomFromText('POINT(%s %s)',4617),{appconfig.dataSrid}), %s,%s, UPPER(%s));
+        SELECT id, cabd_id, original_point, name, fall_height_m, passability_status
+        FROM {dbTargetSchema}.{dbBarrierTable}
+        WHERE type = 'waterfall';
     """
     with conn.cursor() as cursor:
-        for feature in output_data:
-            cursor.execute(insertquery, feature)
+        cursor.execute(query)
     conn.commit()
 
     # snaps barrier features to network
@@ -470,19 +457,9 @@ def addPassability(conn, specCodes):
                 passability_feature.append(feature[1])
             passability_data.append(passability_feature)
                     
-    insertquery = f"""
-        INSERT INTO {dbTargetSchema}.barrier_passability (
-            barrier_id
-            ,species_id
-            ,passability_status
-            )
-        VALUES (%s, %s, UPPER(%s));
-
-        
-    """
-    with conn.cursor() as cursor:
-        for feature in passability_data:
-            cursor.execute(insertquery, feature)
+    bulk_update.insertRows(conn, f"{dbTargetSchema}.barrier_passability",
+        ["barrier_id", "species_id", "passability_status"],
+        passability_data, "(%s, %s, UPPER(%s))")
     conn.commit()
 
     updatequery = f"""
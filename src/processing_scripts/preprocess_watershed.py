@@ -22,6 +22,11 @@
 import appconfig
 import ast
 
+if __package__:
+    from . import stream_network
+else:
+    import stream_network
+
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
 
@@ -128,6 +133,8 @@ def main():
             cursor.execute(query)
         conn.commit()
 
+    stream_network.clearNetwork()
+
     print(f"""Initializing processing for watershed {workingWatershedId} complete.""")
 
 if __name__ == "__main__":
@@ -20,6 +20,364 @@
 # This script generates a query to automatically rank barriers in a watershed
 
 import appconfig
+import os
+import multiprocessing
+
+if __package__:
+    from . import bulk_update
+else:
+    import bulk_update
+
+iniSection = appconfig.args.args[0]
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+species = appconfig.config[iniSection]['species']
+rankAllSpecies = appconfig.config['BARRIER_PROCESSING'].getboolean('rank_all_species', True)
+rankWorkers = appconfig.config['BARRIER_PROCESSING'].getint('rank_workers', 1)
+
+#barriers for each species used by the worker processes
+workerBarriers = None
+
+
+class RankedBarrier:
+    """
+    The attributes of a barrier used for ranking and the computed 
+    group, group gains and ranks
+    """
+    def __init__(self, bid, mainstem_id, barrier_cnt_upstr, barrier_cnt_downstr, barriers_downstr, 
+                 func_upstr_hab, w_func_upstr_hab, w_total_upstr_hab):
+        self.id = bid
+        self.mainstem_id = mainstem_id
+        self.barrier_cnt_upstr = barrier_cnt_upstr
+        self.barrier_cnt_downstr = barrier_cnt_downstr
+        self.barriers_downstr = barriers_downstr if barriers_downstr is not None else []
+        self.func_upstr_hab = func_upstr_hab
+        self.w_func_upstr_hab = w_func_upstr_hab
+        self.w_total_upstr_hab = w_total_upstr_hab
+        
+        self.group_id = None
+        self.total_hab_gain_group = None
+        self.w_total_hab_gain_group = None
+        self.num_barriers_group = None
+        self.avg_gain_per_barrier = None
+        self.w_avg_gain_per_barrier = None
+        self.downstr_group_ids = None
+        self.rank_w_avg_gain_tiered = None
+        self.rank_w_total_upstr_hab = None
+        self.rank_combined = None
+        self.tier_combined = None
+        self.passability_status = None
+
+
+def nullsFirst(value, descending = False):
+    """
+    sort key for nullable values; nulls sort before all values
+    """
+    if value is None:
+        return (0, 0)
+    return (1, -value if descending else value)
+
+
+def nullsLast(value, descending = False):
+    """
+    sort key for nullable values; nulls sort after all values
+    """
+    if value is None:
+        return (1, 0)
+    return (0, -value if descending else value)
+
+
+def sumValues(values):
+    """
+    sum of the non null values; null if all values are null
+    """
+    values = [value for value in values if value is not None]
+    return sum(values) if len(values) > 0 else None
+
+
+def groupKey(barrier):
+    """
+    barriers that are not grouped are their own group
+    """
+    return barrier.group_id if barrier.group_id is not None else barrier
+
+
+def peerBlocks(barriers):
+    """
+    :param barriers: barriers ordered by the number of upstream barriers 
+        (most first)
+    :returns: list of [start, end, total, count] blocks of the barriers 
+        with the same number of upstream barriers; total and count only 
+        include the barriers with a weighted functional habitat gain
+    """
+    blocks = []
+    for i, barrier in enumerate(barriers):
+        if i == 0 or barriers[i - 1].barrier_cnt_upstr != barrier.barrier_cnt_upstr:
+            blocks.append([i, i, 0, 0])
+        blocks[-1][1] = i + 1
+        if barrier.w_func_upstr_hab is not None:
+            blocks[-1][2] += barrier.w_func_upstr_hab
+            blocks[-1][3] += 1
+    return blocks
+
+
+def hasBetterAverage(block, previous):
+    """
+    :returns: True if the average gain of the block is greater than or equal
+        to the average gain of the previous block; blocks without any gains 
+        have no average and are always merged with their neighbour
+    """
+    if block[3] == 0 or previous[3] == 0:
+        return True
+    return block[2] * previous[3] >= previous[2] * block[3]
+
+
+def assignGroups(barriers):
+    """
+    Groups the barriers on each mainstem. The barriers are ordered by the 
+    number of upstream barriers (most first) and split so the first group 
+    is the longest prefix with the best average weighted functional habitat 
+    gain, the next group is the best prefix of the remaining barriers, and 
+    so on. Barriers with the same number of upstream barriers are always 
+    in the same group.
+    
+    The groups are found in a single sweep over the blocks of peer barriers: 
+    each block is pushed on a stack after merging in the blocks on top of 
+    the stack with an average gain that is not greater than its own, which 
+    leaves the stack holding the groups with decreasing average gains. As 
+    with the average of the prefixes, barriers without a gain are not 
+    included in the averages.
+    
+    Group ids are <mainstem group> * offset + <split number> where the 
+    offset is ten times the number of barriers. Barriers without a 
+    mainstem are not grouped.
+    """
+    offset = len(barriers) * 10
+    
+    mainstems = {}
+    for barrier in barriers:
+        if barrier.mainstem_id is not None:
+            mainstems.setdefault(barrier.mainstem_id, []).append(barrier)
+    
+    for mainstem, (mainstem_id, members) in enumerate(mainstems.items(), start=1):
+        members.sort(key=lambda barrier: nullsFirst(barrier.barrier_cnt_upstr, descending=True))
+        
+        stack = []
+        for block in peerBlocks(members):
+            #merge while the new block average >= the previous block average
+            while stack and hasBetterAverage(block, stack[-1]):
+                top = stack.pop()
+                block = [top[0], block[1], top[2] + block[2], top[3] + block[3]]
+            stack.append(block)
+        
+        for split, (start, end, total, count) in enumerate(stack, start=2):
+            for barrier in members[start:end]:
+                barrier.group_id = mainstem * offset + split
+
+
+def computeGroupGains(barriers):
+    """
+    Computes the total and average habitat gain of each group; 
+    barriers that are not grouped are their own group
+    """
+    groups = {}
+    for barrier in barriers:
+        groups.setdefault(groupKey(barrier), []).append(barrier)
+    
+    for barrier in barriers:
+        members = groups[groupKey(barrier)]
+        
+        barrier.total_hab_gain_group = sumValues(member.func_upstr_hab for member in members)
+        barrier.w_total_hab_gain_group = sumValues(member.w_func_upstr_hab for member in members)
+        barrier.num_barriers_group = len(members)
+        
+        if barrier.total_hab_gain_group is not None:
+            barrier.avg_gain_per_barrier = barrier.total_hab_gain_group / barrier.num_barriers_group
+        if barrier.w_total_hab_gain_group is not None:
+            barrier.w_avg_gain_per_barrier = barrier.w_total_hab_gain_group / barrier.num_barriers_group
+
+
+def assignDownstreamGroups(barriers):
+    """
+    Finds the groups (other than its own) of the ranked barriers 
+    downstream of each barrier
+    """
+    groupids = {str(barrier.id): barrier.group_id for barrier in barriers}
+    
+    for barrier in barriers:
+        if barrier.group_id is None:
+            continue
+        
+        downstr = set()
+        for bid in barrier.barriers_downstr:
+            group_id = groupids.get(str(bid))
+            if group_id is not None and group_id != barrier.group_id:
+                downstr.add(group_id)
+        
+        if len(downstr) > 0:
+            barrier.downstr_group_ids = [str(group_id) for group_id in sorted(downstr)]
+
+
+def denseRank(barriers, key):
+    """
+    :returns: dictionary of barrier to the dense rank of the key
+    """
+    values = sorted(set(key(barrier) for barrier in barriers))
+    ranks = {value: rank for rank, value in enumerate(values, start=1)}
+    return {barrier: ranks[key(barrier)] for barrier in barriers}
+
+
+def assignRanks(barriers):
+    """
+    Ranks the barriers by immediate gain (tiered by the number of downstream 
+    barriers), by potential gain (total upstream habitat) and by the
+    combination of both. Barriers in a group share the rank of the best 
+    barrier in the group.
+    """
+    
+    # Rank based on first sorting the barriers into tiers by number of downstream barriers 
+    # then by avg gain per barrier within those tiers (immediate gain)
+    tierkey = lambda barrier: (nullsLast(barrier.barrier_cnt_downstr), -barrier.w_avg_gain_per_barrier)
+    high = sorted([b for b in barriers if b.w_avg_gain_per_barrier is not None and b.w_avg_gain_per_barrier >= 0.5], key=tierkey)
+    low = sorted([b for b in barriers if b.w_avg_gain_per_barrier is not None and b.w_avg_gain_per_barrier < 0.5], key=tierkey)
+    
+    rownum = {}
+    for i, barrier in enumerate(high):
+        rownum[barrier] = i + 1
+    for i, barrier in enumerate(low):
+        rownum[barrier] = len(high) + i + 1 if len(high) > 0 else None
+    
+    #the rank of the group is the rank of the barrier in the group 
+    #with the fewest downstream barriers
+    partitions = {}
+    for barrier in high + low:
+        partitions.setdefault(groupKey(barrier), []).append(barrier)
+    for members in partitions.values():
+        first = min(members, key=lambda barrier: nullsLast(barrier.barrier_cnt_downstr))
+        for barrier in members:
+            barrier.rank_w_avg_gain_tiered = rownum[first]
+    
+    # Rank based on total habitat upstream (potential gain)
+    ordered = sorted(barriers, key=lambda barrier: nullsFirst(barrier.w_total_upstr_hab, descending=True))
+    rownum = {barrier: i + 1 for i, barrier in enumerate(ordered)}
+    
+    relative = {}
+    for barrier in ordered:
+        relative.setdefault(groupKey(barrier), rownum[barrier])
+    ranks = denseRank(barriers, lambda barrier: relative[groupKey(barrier)])
+    for barrier in barriers:
+        barrier.rank_w_total_upstr_hab = ranks[barrier]
+    
+    # Composite Rank of potential and immediate gain
+    def combinedKey(barrier):
+        combined = None
+        if barrier.rank_w_avg_gain_tiered is not None:
+            combined = barrier.rank_w_avg_gain_tiered + barrier.rank_w_total_upstr_hab
+        return (nullsLast(combined), nullsLast(barrier.group_id))
+    
+    ranks = denseRank(barriers, combinedKey)
+    for barrier in barriers:
+        barrier.rank_combined = ranks[barrier]
+        if barrier.rank_combined <= 10:
+            barrier.tier_combined = 'A'
+        elif barrier.rank_combined <= 20:
+            barrier.tier_combined = 'B'
+        elif barrier.rank_combined <= 30:
+            barrier.tier_combined = 'C'
+        else:
+            barrier.tier_combined = 'D'
+
+
+def rankBarrierList(barriers):
+    """
+    Computes the groups, group gains and ranks of the barriers in memory
+    :param barriers: list of RankedBarrier
+    """
+    assignGroups(barriers)
+    computeGroupGains(barriers)
+    assignDownstreamGroups(barriers)
+    assignRanks(barriers)
+
+
+def loadRankingBarriers(conn, table, species_code):
+    """
+    Loads the barrier attributes used for ranking from the ranking table
+    :returns: list of RankedBarrier
+    """
+    query = f"""
+        SELECT id, mainstem_id, barrier_cnt_upstr_{species_code}, barrier_cnt_downstr_{species_code},
+            barriers_downstr_{species_code}, func_upstr_hab_{species_code}, 
+            w_func_upstr_hab_{species_code}, w_total_upstr_hab_{species_code}
+        FROM {table}
+        ORDER BY id
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+        return [RankedBarrier(*feature) for feature in cursor.fetchall()]
+
+
+#ranking results written back to the ranking table as
+#(name, column type, staging type, assignment)
+RANK_COLUMNS = [
+    ('group_id', 'numeric', 'bigint', None),
+    ('total_hab_gain_group', 'numeric', 'double precision', None),
+    ('w_total_hab_gain_group', 'numeric', 'double precision', None),
+    ('num_barriers_group', 'integer', 'integer', None),
+    ('avg_gain_per_barrier', 'numeric', 'double precision', None),
+    ('w_avg_gain_per_barrier', 'numeric', 'double precision', None),
+    ('downstr_group_ids', 'varchar[]', 'text', "string_to_array(s.downstr_group_ids, ',')::varchar[]"),
+    ('rank_w_avg_gain_tiered', 'numeric', 'bigint', None),
+    ('rank_w_total_upstr_hab', 'numeric', 'bigint', None),
+    ('rank_combined', 'numeric', 'bigint', None),
+    ('tier_combined', 'varchar', 'varchar', None),
+]
+
+
+def rankValues(barrier):
+    values = []
+    for name, columntype, stagingtype, assignment in RANK_COLUMNS:
+        value = getattr(barrier, name)
+        if name == 'downstr_group_ids' and value is not None:
+            value = ','.join(value)
+        values.append(value)
+    return values
+
+
+def writeRanks(conn, table, barriers):
+    """
+    Writes the groups, group gains and ranks to the ranking table with a single bulk update
+    """
+    query = ''.join(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {name} {columntype};\n" 
+                    for name, columntype, stagingtype, assignment in RANK_COLUMNS)
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+    
+    columns = [('id', 'uuid')] + [(name, stagingtype) for name, columntype, stagingtype, assignment in RANK_COLUMNS]
+    assignments = {name: assignment if assignment else f"s.{name}" for name, columntype, stagingtype, assignment in RANK_COLUMNS}
+    rows = [[barrier.id] + rankValues(barrier) for barrier in barriers]
+    
+    bulk_update.updateTable(conn, table, 'id', columns, rows, assignments)
+
+
+def dropRelation(conn, schema, name):
+    """
+    Drops the table or view (and everything that depends on it); rankings
+    written by older versions may be views
+    """
+    query = """
+        SELECT c.relkind 
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(query, (schema, name))
+        relation = cursor.fetchone()
+    
+    if relation is None:
+        return
+    
+    relationtype = "VIEW" if relation[0] == 'v' else "TABLE"
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP {relationtype} IF EXISTS {schema}.{name} CASCADE;")
 
 
 def rank_barriers(wcrp, watershed, watershed_name, species_code, conn):
@@ -33,9 +391,9 @@ def rank_barriers(wcrp, watershed, watershed_name, species_code, conn):
 
     """
 
-    query = f"""
-    DROP TABLE IF EXISTS {wcrp}.ranked_barriers_{species_code}_{watershed} CASCADE;
+    dropRelation(conn, wcrp, f"ranked_barriers_{species_code}_{watershed}")
 
+    query = f"""
     WITH barrier_passability_{species_code} 
     AS (
         SELECT bp.barrier_id, bp.passability_status
@@ -104,270 +462,238 @@ def rank_barriers(wcrp, watershed, watershed_name, species_code, conn):
     CREATE INDEX ranked_barriers_{species_code}_{watershed}_idx_mainstem ON {wcrp}.ranked_barriers_{species_code}_{watershed} (mainstem_id);
     CREATE INDEX ranked_barriers_{species_code}_{watershed}_idx_group_id ON {wcrp}.ranked_barriers_{species_code}_{watershed} (group_id);
     CREATE INDEX ranked_barriers_{species_code}_{watershed}_idx_id ON {wcrp}.ranked_barriers_{species_code}_{watershed} (id);
-
-    WITH mainstems AS (
-    SELECT DISTINCT mainstem_id, row_number() OVER () AS group_id
-    FROM {wcrp}.ranked_barriers_{species_code}_{watershed}
-    )
-
-    UPDATE {wcrp}.ranked_barriers_{species_code}_{watershed} a SET group_id = m.group_id FROM mainstems m WHERE m.mainstem_id = a.mainstem_id;
     """
 
     with conn.cursor() as cursor:
         cursor.execute(query)
-    conn.commit()
-        
+    
+    #groups, group gains and ranks are computed in memory and 
+    #written back with a single bulk update
+    table = f"{wcrp}.ranked_barriers_{species_code}_{watershed}"
+    barriers = loadRankingBarriers(conn, table, species_code)
+    rankBarrierList(barriers)
+    writeRanks(conn, table, barriers)
+    
     query = f"""
-    DO $$
-    DECLARE
-        continue_loop BOOLEAN := TRUE;
-        i INT := 1;
-        grp_offset INT := (SELECT COUNT(*)*10 FROM {wcrp}.ranked_barriers_{species_code}_{watershed});
-    BEGIN
-        WHILE continue_loop LOOP
-            
-            i := i + 1;
-        
-            perform id, group_id
-            from {wcrp}.ranked_barriers_{species_code}_{watershed}
-            where group_id < grp_offset
-            LIMIT 1;
-
-            IF NOT FOUND THEN
-                continue_loop := FALSE;
-            ELSE
-                with avgVals as (
-                    select id, mainstem_id, group_id, barrier_cnt_upstr_{species_code}, func_upstr_hab_{species_code}
-                        ,AVG(w_func_upstr_hab_{species_code}) OVER(PARTITION BY group_id ORDER BY barrier_cnt_upstr_{species_code} DESC) as average
-                        ,ROW_NUMBER() OVER(PARTITION BY group_id ORDER BY barrier_cnt_upstr_{species_code} DESC) as row_num
-                    from {wcrp}.ranked_barriers_{species_code}_{watershed}
-                    where group_id < grp_offset
-                    order by group_id, barrier_cnt_upstr_{species_code} DESC
-                ),
-                max_grp_gain as (
-                    select 
-                        group_id
-                        ,max(average) as best_gain
-                    from avgVals
-                    group by group_id
-                    order by group_id
-                ),
-                part as (
-                    select mx.*, av.row_num 
-                    from max_grp_gain mx
-                    join avgVals av on mx.best_gain = av.average
-                ),
-                new_grps as (
-                    select av.id
-                        ,CASE 
-                            WHEN av.row_num <= part.row_num THEN (av.group_id*grp_offset) + i
-                            ELSE av.group_id
-                        END as new_group_id
-                    from avgVals av
-                    join part on av.group_id = part.group_id
-                )
-
-                update {wcrp}.ranked_barriers_{species_code}_{watershed}
-                set group_id = new_grps.new_group_id
-                from new_grps
-                where {wcrp}.ranked_barriers_{species_code}_{watershed}.id = new_grps.id
-                AND new_grps.new_group_id > grp_offset;
-
-            END IF;
-        END LOOP;
-    END $$;
-
-    select id, mainstem_id, group_id, barrier_cnt_upstr_{species_code}, func_upstr_hab_{species_code}
-        ,AVG(w_func_upstr_hab_{species_code}) OVER(PARTITION BY group_id ORDER BY barrier_cnt_upstr_{species_code} DESC) as average
-        ,ROW_NUMBER() OVER(PARTITION BY group_id ORDER BY barrier_cnt_upstr_{species_code} DESC) as row_num
-    from {wcrp}.ranked_barriers_{species_code}_{watershed}
-    order by group_id, barrier_cnt_upstr_{species_code} DESC;
-
-
-        
-    ----------------- CALCULATE GROUP GAINS -------------------------	
-        
-    alter table {wcrp}.ranked_barriers_{species_code}_{watershed} add column total_hab_gain_group numeric;
-    alter table {wcrp}.ranked_barriers_{species_code}_{watershed} add column w_total_hab_gain_group numeric;
-    alter table {wcrp}.ranked_barriers_{species_code}_{watershed} add column num_barriers_group integer;
-    alter table {wcrp}.ranked_barriers_{species_code}_{watershed} add column avg_gain_per_barrier numeric;
-    alter table {wcrp}.ranked_barriers_{species_code}_{watershed} add column w_avg_gain_per_barrier numeric;
-
-    with temp as (
-        SELECT 
-            sum(w_func_upstr_hab_{species_code}) AS w_sum
-            ,sum(func_upstr_hab_{species_code}) AS sum
-            ,group_id
-        from {wcrp}.ranked_barriers_{species_code}_{watershed}
-        group by group_id
-    )
+    ALTER TABLE {wcrp}.ranked_barriers_{species_code}_{watershed}
+    DROP COLUMN stream_id_up;
+    """
 
-    update {wcrp}.ranked_barriers_{species_code}_{watershed} a 
-    SET 
-        total_hab_gain_group = t.sum
-        ,w_total_hab_gain_group = t.w_sum 
-    FROM temp t 
-    WHERE t.group_id = a.group_id;
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+    conn.commit()
+    return
 
-    update {wcrp}.ranked_barriers_{species_code}_{watershed} SET total_hab_gain_group = func_upstr_hab_{species_code} WHERE group_id IS NULL;
-    update {wcrp}.ranked_barriers_{species_code}_{watershed} SET w_total_hab_gain_group = w_func_upstr_hab_{species_code} WHERE group_id IS NULL;
 
-    with temp as (
-        SELECT count(*) AS cnt, group_id
-        from {wcrp}.ranked_barriers_{species_code}_{watershed}
-        group by group_id
-    )
+#per species barrier attributes loaded for ranking 
+SPECIES_FIELDS = [
+    'barrier_cnt_upstr', 'barrier_cnt_downstr', 'barriers_downstr', 'func_upstr_hab', 
+    'total_upstr_hab', 'w_func_upstr_hab', 'w_total_upstr_hab'
+]
 
 
-    update {wcrp}.ranked_barriers_{species_code}_{watershed} a SET num_barriers_group = t.cnt FROM temp t WHERE t.group_id = a.group_id;
-    update {wcrp}.ranked_barriers_{species_code}_{watershed} SET num_barriers_group = 1 WHERE group_id IS NULL;
-
-    update {wcrp}.ranked_barriers_{species_code}_{watershed} SET avg_gain_per_barrier = total_hab_gain_group / num_barriers_group;
-    update {wcrp}.ranked_barriers_{species_code}_{watershed} SET w_avg_gain_per_barrier = w_total_hab_gain_group / num_barriers_group;
-
-    ---------------GET DOWNSTREAM GROUP IDs----------------------------
-
-    ALTER TABLE {wcrp}.ranked_barriers_{species_code}_{watershed} ADD downstr_group_ids varchar[];
-
-    WITH downstr_barriers AS (
-        SELECT rb.id, rb.group_id
-            ,UNNEST(barriers_downstr_{species_code}) AS barriers_downstr_{species_code}
-        FROM {wcrp}.ranked_barriers_{species_code}_{watershed} rb
-    ),
-    downstr_group AS (
-        SELECT db_.id, db_.group_id as current_group, db_.barriers_downstr_{species_code}
-            ,rb.group_id
-        FROM downstr_barriers AS db_
-        JOIN {wcrp}.ranked_barriers_{species_code}_{watershed} rb
-            ON rb.id = db_.barriers_downstr_{species_code}::uuid
-        WHERE db_.group_id != rb.group_id
-    ), 
-    dg_arrays AS (
-        SELECT dg.id, ARRAY_AGG(DISTINCT dg.group_id)::varchar[] as downstr_group_ids
-        FROM downstr_group dg
-        GROUP BY dg.id
-    )
-    UPDATE {wcrp}.ranked_barriers_{species_code}_{watershed}
-    SET downstr_group_ids = dg_arrays.downstr_group_ids
-    FROM dg_arrays
-    WHERE {wcrp}.ranked_barriers_{species_code}_{watershed}.id = dg_arrays.id;
-
-
-    ----------------- ASSIGN RANK ID  -------------------------	
-
-    -- Rank based on first sorting the barriers into tiers by number of downstream barriers then by avg gain per barrier within those tiers (immediate gain)
-    ALTER TABLE {wcrp}.ranked_barriers_{species_code}_{watershed} 
-    ADD rank_w_avg_gain_tiered numeric;
-
-    WITH sorted AS (
-        SELECT id, group_id, barrier_cnt_upstr_{species_code}, barrier_cnt_downstr_{species_code}, w_total_hab_gain_group, w_avg_gain_per_barrier
-            ,passability_status
-            ,ROW_NUMBER() OVER(ORDER BY barrier_cnt_downstr_{species_code}, w_avg_gain_per_barrier DESC) as row_num
-        FROM {wcrp}.ranked_barriers_{species_code}_{watershed}
-        WHERE w_avg_gain_per_barrier >= 0.5
-        UNION ALL
-        SELECT id, group_id, barrier_cnt_upstr_{species_code}, barrier_cnt_downstr_{species_code}, w_total_hab_gain_group, w_avg_gain_per_barrier
-            ,passability_status
-            ,(SELECT MAX(row_num) FROM (
-                SELECT ROW_NUMBER() OVER(ORDER BY barrier_cnt_downstr_{species_code}, w_avg_gain_per_barrier DESC) as row_num
-                FROM {wcrp}.ranked_barriers_{species_code}_{watershed}
-                WHERE w_avg_gain_per_barrier >= 0.5
-            ) AS subquery) + ROW_NUMBER() OVER(ORDER BY barrier_cnt_downstr_{species_code}, w_avg_gain_per_barrier DESC) as row_num 
-        FROM {wcrp}.ranked_barriers_{species_code}_{watershed}
-        WHERE w_avg_gain_per_barrier < 0.5
+def loadAllSpeciesBarriers(conn, wcrp, specCodes):
+    """
+    Loads the barriers and the passability of all species once and
+    creates the list of barriers to rank for each species; barriers
+    that are passable, have no upstream habitat or are waterfalls are 
+    not ranked
+    :returns: dictionary of species code to list of RankedBarrier
+    """
+    fields = ', '.join(f"b.{field}_{code}" for code in specCodes for field in SPECIES_FIELDS)
+    
+    query = f"""
+        SELECT b.id, t.mainstem_id, {fields}
+        FROM {wcrp}.barriers b
+        LEFT JOIN {wcrp}.streams t ON t.id = b.stream_id_up
+        WHERE b.type != 'waterfall'
+        ORDER BY b.id
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+    
+    query = f"""
+        SELECT bp.barrier_id, f.code, bp.passability_status
+        FROM {wcrp}.barrier_passability bp
+        JOIN {wcrp}.fish_species f ON f.id = bp.species_id
+        WHERE f.code IN ({','.join(f"'{code}'" for code in specCodes)})
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+        passability = {(bid, code): status for bid, code, status in cursor.fetchall()}
+    
+    barriers = {code: [] for code in specCodes}
+    for feature in features:
+        bid = feature[0]
+        mainstem_id = feature[1]
         
-    ),
-    ranks AS (
-        SELECT id
-            ,FIRST_VALUE(row_num) OVER(PARTITION BY group_id ORDER BY barrier_cnt_downstr_{species_code}) as ranks
-            ,FIRST_VALUE(barrier_cnt_downstr_{species_code}) OVER (PARTITION BY group_id ORDER BY barrier_cnt_downstr_{species_code}) as tier
-        FROM sorted
-        ORDER BY group_id, barrier_cnt_downstr_{species_code}, w_avg_gain_per_barrier DESC
-    )
-    UPDATE {wcrp}.ranked_barriers_{species_code}_{watershed} 
-    SET rank_w_avg_gain_tiered = ranks.ranks
-    FROM ranks
-    WHERE {wcrp}.ranked_barriers_{species_code}_{watershed}.id = ranks.id;
-
-    -- Rank based on total habitat upstream (potential gain)
-    ALTER TABLE {wcrp}.ranked_barriers_{species_code}_{watershed} 
-    ADD rank_w_total_upstr_hab numeric;
-
-    WITH sorted AS (
-        SELECT id, group_id, barrier_cnt_upstr_{species_code}, barrier_cnt_downstr_{species_code}, w_total_upstr_hab_{species_code}, w_total_hab_gain_group, w_avg_gain_per_barrier
-            ,ROW_NUMBER() OVER(ORDER BY w_total_upstr_hab_{species_code} DESC) as row_num
-        FROM {wcrp}.ranked_barriers_{species_code}_{watershed}
-    ),
-    ranks AS (
-        SELECT id, group_id, barrier_cnt_upstr_{species_code}, barrier_cnt_downstr_{species_code}, w_total_upstr_hab_{species_code}, w_total_hab_gain_group, w_avg_gain_per_barrier
-            ,FIRST_VALUE(row_num) OVER(PARTITION BY group_id ORDER BY row_num) as relative_rank
-        FROM sorted
-        ORDER BY group_id, barrier_cnt_downstr_{species_code}, w_avg_gain_per_barrier DESC
-    ),
-    densify AS (
-        SELECT id, group_id, barrier_cnt_upstr_{species_code}, barrier_cnt_downstr_{species_code}, w_total_upstr_hab_{species_code}, w_total_hab_gain_group, w_avg_gain_per_barrier
-            ,DENSE_RANK() OVER(ORDER BY relative_rank) as ranks
-        FROM ranks
-    )
-    UPDATE {wcrp}.ranked_barriers_{species_code}_{watershed} 
-    SET rank_w_total_upstr_hab = densify.ranks
-    FROM densify
-    WHERE {wcrp}.ranked_barriers_{species_code}_{watershed}.id = densify.id;
-
-    -- Composite Rank of potential and immediate gain with upstream habitat cutoff
-    ALTER TABLE {wcrp}.ranked_barriers_{species_code}_{watershed} 
-    ADD rank_combined numeric;
-
-    WITH ranks AS (
-        SELECT id, group_id, barrier_cnt_upstr_{species_code}, barrier_cnt_downstr_{species_code}, total_upstr_hab_{species_code}, total_hab_gain_group, avg_gain_per_barrier
-            ,rank_w_avg_gain_tiered
-            ,rank_w_total_upstr_hab
-            ,DENSE_RANK() OVER(ORDER BY rank_w_avg_gain_tiered + rank_w_total_upstr_hab, group_id ASC) as rank_composite
-        FROM {wcrp}.ranked_barriers_{species_code}_{watershed}
-        ORDER BY rank_composite ASC
-    )
-    UPDATE {wcrp}.ranked_barriers_{species_code}_{watershed}
-    SET rank_combined = ranks.rank_composite
-    FROM ranks
-    WHERE {wcrp}.ranked_barriers_{species_code}_{watershed}.id = ranks.id;
-
-    -- Potential and immediate with weight by downstream barriers
-    ALTER TABLE {wcrp}.ranked_barriers_{species_code}_{watershed} 
-    ADD tier_combined varchar;
-
-    WITH ranks AS (
-        SELECT id, group_id, barrier_cnt_upstr_{species_code}, barrier_cnt_downstr_{species_code}, w_total_upstr_hab_{species_code}, w_total_hab_gain_group, w_avg_gain_per_barrier
-            ,rank_w_avg_gain_tiered
-            ,rank_w_total_upstr_hab
-            ,rank_combined
-            ,DENSE_RANK() OVER(ORDER BY LEAST(rank_w_avg_gain_tiered, rank_w_total_upstr_hab), group_id ASC) as rank_composite
-        FROM {wcrp}.ranked_barriers_{species_code}_{watershed}
-    )
-    UPDATE {wcrp}.ranked_barriers_{species_code}_{watershed}
-    SET tier_combined = case
-                when r.rank_combined <= 10 then 'A'
-                when r.rank_combined <= 20 then 'B'
-                when r.rank_combined <= 30 then 'C'
-                else 'D'
-            end
-    FROM ranks r
-    WHERE {wcrp}.ranked_barriers_{species_code}_{watershed}.id = r.id;
+        for index, code in enumerate(specCodes):
+            upcnt, downcnt, downstr, func, total, w_func, w_total = feature[2 + index * len(SPECIES_FIELDS):2 + (index + 1) * len(SPECIES_FIELDS)]
+            status = passability.get((bid, code))
+            
+            if status is None or status == '1' or total is None or total == 0:
+                continue
+            
+            #weighted habitat is the habitat that would be gained by making the barrier passable
+            factor = 1 - float(status)
+            w_func = w_func * factor if w_func is not None else None
+            w_total = w_total * factor if w_total is not None else None
+            
+            barrier = RankedBarrier(bid, mainstem_id, upcnt, downcnt, downstr, func, w_func, w_total)
+            barrier.passability_status = status
+            barriers[code].append(barrier)
+    
+    return barriers
 
-    ALTER TABLE {wcrp}.ranked_barriers_{species_code}_{watershed}
-    DROP COLUMN stream_id_up;
 
+def rankSpeciesWorker(code):
+    """
+    Ranks the barriers of one species in a worker process
     """
+    barriers = workerBarriers[code]
+    rankBarrierList(barriers)
+    return code, barriers
 
+
+def rankAllSpeciesBarriers(barriers, workers):
+    """
+    Ranks the barriers of each species, in parallel if more than one worker
+    :param barriers: dictionary of species code to list of RankedBarrier
+    :returns: dictionary of species code to the ranked barriers
+    """
+    global workerBarriers
+    
+    if (workers > 1 and 'fork' not in multiprocessing.get_all_start_methods()):
+        #spawned processes re-import appconfig which prompts for credentials
+        print("  WARNING: parallel processing is not supported on this platform; ranking species sequentially")
+        workers = 1
+    workers = min(workers, len(barriers))
+    
+    if (workers <= 1):
+        for code in barriers:
+            rankBarrierList(barriers[code])
+        return barriers
+    
+    ranked = {}
+    workerBarriers = barriers
+    try:
+        context = multiprocessing.get_context('fork')
+        with context.Pool(workers) as pool:
+            for code, rankedbarriers in pool.imap_unordered(rankSpeciesWorker, list(barriers.keys())):
+                ranked[code] = rankedbarriers
+    finally:
+        workerBarriers = None
+    return ranked
+
+
+def writeAllSpeciesRanks(conn, wcrp, watershed, specCodes, barriers):
+    """
+    Writes the rankings of all species to a single long format table 
+    (one row per barrier and species) with one bulk write and creates 
+    a table for each species with the same name and columns as the
+    tables of the per species ranking mode; these are tables rather than views so 
+    they don't depend on the barrier table, which is dropped and 
+    recreated when the barriers are reloaded
+    """
+    table = f"{wcrp}.ranked_barriers_{watershed}"
+    
+    for code in specCodes:
+        dropRelation(conn, wcrp, f"ranked_barriers_{code}_{watershed}")
+    dropRelation(conn, wcrp, f"ranked_barriers_{watershed}")
+    
+    rankcolumns = ''.join(f",\n            {name} {columntype}" for name, columntype, stagingtype, assignment in RANK_COLUMNS)
+    query = f"""
+        CREATE TABLE {table} (
+            id uuid NOT NULL,
+            species_code varchar NOT NULL,
+            mainstem_id uuid,
+            passability_status varchar,
+            w_func_upstr_hab double precision,
+            w_total_upstr_hab double precision{rankcolumns},
+            PRIMARY KEY (id, species_code)
+        );
+    """
     with conn.cursor() as cursor:
         cursor.execute(query)
+    
+    columns = [('id', 'uuid'), ('species_code', 'varchar'), ('mainstem_id', 'uuid'), ('passability_status', 'varchar'),
+               ('w_func_upstr_hab', 'double precision'), ('w_total_upstr_hab', 'double precision')]
+    columns.extend((name, stagingtype) for name, columntype, stagingtype, assignment in RANK_COLUMNS)
+    
+    rows = []
+    for code in specCodes:
+        for barrier in barriers[code]:
+            rows.append([barrier.id, code, barrier.mainstem_id, barrier.passability_status, 
+                         barrier.w_func_upstr_hab, barrier.w_total_upstr_hab] + rankValues(barrier))
+    
+    staging = bulk_update.loadStaging(conn, columns, rows)
+    
+    expressions = [f"s.{name}" for name, columntype in columns[:6]]
+    expressions.extend(assignment if assignment else f"s.{name}" for name, columntype, stagingtype, assignment in RANK_COLUMNS)
+    query = f"""
+        INSERT INTO {table} ({', '.join(name for name, columntype in columns)})
+        SELECT {', '.join(expressions)} FROM {staging} s;
+        
+        DROP TABLE {staging};
+        
+        CREATE INDEX ranked_barriers_{watershed}_idx_species ON {table} (species_code);
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+    
+    rankfields = ''.join(f"\n            ,r.{name}" for name, columntype, stagingtype, assignment in RANK_COLUMNS)
+    for code in specCodes:
+        query = f"""
+        CREATE TABLE {wcrp}.ranked_barriers_{code}_{watershed} AS
+        SELECT b.id
+            ,b.name
+            ,b.type
+            ,b.owner
+            ,b.passability_status_notes
+            ,b.dam_use
+            ,b.stream_name
+            ,b.strahler_order
+            ,b.wshed_name
+            ,b.crossing_status
+            ,b.crossing_feature_type
+            ,b.culvert_number
+            ,b.structure_id
+            ,b.date_examined
+            ,b.culvert_type
+            ,b.culvert_condition
+            ,b.barrier_cnt_upstr_{code}
+            ,b.barriers_upstr_{code}
+            ,b.barrier_cnt_downstr_{code}
+            ,b.barriers_downstr_{code}
+            ,b.total_upstr_hab_all
+            ,b.func_upstr_hab_all
+            ,b.original_point
+            ,b.snapped_point
+            ,b.func_upstr_hab_{code} 
+            ,b.total_upstr_hab_{code}
+            ,r.w_func_upstr_hab AS w_func_upstr_hab_{code}
+            ,r.w_total_upstr_hab AS w_total_upstr_hab_{code}
+            ,r.passability_status
+            ,r.mainstem_id{rankfields}
+        FROM {table} r
+        JOIN {wcrp}.barriers b ON b.id = r.id
+        WHERE r.species_code = '{code}';
+        
+        ALTER TABLE {wcrp}.ranked_barriers_{code}_{watershed} ADD PRIMARY KEY (id);
+        CREATE INDEX ranked_barriers_{code}_{watershed}_idx_mainstem ON {wcrp}.ranked_barriers_{code}_{watershed} (mainstem_id);
+        CREATE INDEX ranked_barriers_{code}_{watershed}_idx_group_id ON {wcrp}.ranked_barriers_{code}_{watershed} (group_id);
+        """
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+    
     conn.commit()
-    return
 
 
 def main():
-    watershed = appconfig.iniSection
-    specCodes = appconfig.getSpecies()
-    wcrp = appconfig.dbOutputSchema
+    watershed = iniSection
+    specCodes = [substring.strip() for substring in species.split(',')]
+    wcrp = dbTargetSchema
 
     with appconfig.connectdb() as conn:
         conn.autocommit = False
@@ -376,9 +702,22 @@ def main():
         print(wcrp)
         print(specCodes)
 
-        for s in specCodes:
-            watershed_name = watershed
-            rank_barriers(wcrp, watershed, watershed_name, s, conn)
+        if rankAllSpecies:
+            #barriers and passability are loaded once and
+            #all species are ranked in memory
+            print("  loading barriers")
+            barriers = loadAllSpeciesBarriers(conn, wcrp, specCodes)
+            
+            print("  ranking barriers")
+            workers = rankWorkers if rankWorkers > 0 else os.cpu_count()
+            barriers = rankAllSpeciesBarriers(barriers, workers)
+            
+            print("  writing results")
+            writeAllSpeciesRanks(conn, wcrp, watershed, specCodes, barriers)
+        else:
+            for s in specCodes:
+                watershed_name = watershed
+                rank_barriers(wcrp, watershed, watershed_name, s, conn)
         
         print("Done!")
 
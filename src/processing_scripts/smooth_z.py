@@ -20,10 +20,14 @@
 # Smooths raw elevation values to ensure hydro network flows downhill
 #
 import appconfig
-import shapely.wkb
-import shapely.geometry
-import psycopg2.extras
-from collections import deque
+import numpy
+import shapely
+
+if __package__:
+    from . import stream_network, bulk_update
+else:
+    import stream_network
+    import bulk_update
 
 iniSection = appconfig.args.args[0]
 dbTargetSchema = appconfig.config[iniSection]['output_schema']
@@ -33,7 +37,7 @@ dbSourceGeom = appconfig.config['ELEVATION_PROCESSING']['3dgeometry_field']
 dbTargetGeom = appconfig.config['ELEVATION_PROCESSING']['smoothedgeometry_field']
     
 edges = []
-nodes = dict()
+nodes = []
 
 class Node:
     
@@ -47,13 +51,13 @@ class Node:
         self.maxvalue = self.z
         
 
-    def addInEdge(self, edge):
+    def addInEdge(self, edge, z):
         self.inedges.append(edge)
-        self.addZ(edge.ls.coords[len(edge.ls.coords) - 1][2])
+        self.addZ(z)
 
-    def addOutEdge(self, edge):
+    def addOutEdge(self, edge, z):
         self.outedges.append(edge)
-        self.addZ(edge.ls.coords[0][2])
+        self.addZ(z)
     
     def addZ(self, z):
         if (self.z == appconfig.NODATA or self.z == z):
@@ -62,192 +66,167 @@ class Node:
             print("DIFFERENT Z VALUES AT SAME POSITION: POINT(" + str(self.x) + " " + str(self.y) + "): " +str(self.x) + " " +str(z))
     
 class Edge:
-    def __init__(self, fromnode, tonode, fid, ls):
+    def __init__(self, fromnode, tonode, fid, index):
         self.fromNode = fromnode
         self.toNode = tonode
-        self.ls = ls
         self.fid = fid
-        self.visited = False
-        self.newz = [appconfig.NODATA for i in range(len(ls.coords))]
+        self.index = index
+
+class Vertices:
+    """
+    The vertices of all edges held in a single flat array; the 
+    vertices of edge i are coords[offsets[i]:offsets[i+1]]
+    """
+    def __init__(self, coords, offsets):
+        self.coords = coords
+        self.offsets = offsets
+        self.newz = numpy.full(len(coords), appconfig.NODATA, dtype=numpy.float64)
         
 def createNetwork(connection):
+    
+    network = stream_network.getNetwork(connection)
+    
+    for i in range(network.nodecount):
+        nodes.append(Node(network.nodexy[i][0], network.nodexy[i][1]))
+    
     query = f"""
         SELECT {appconfig.dbIdField}, {dbSourceGeom}
         FROM {dbTargetSchema}.{dbTargetTable}
     """
    
-    #load geometries and create a network
+    #load geometries in network edge order
     with connection.cursor() as cursor:
         cursor.execute(query)
         features = cursor.fetchall()
+    
+    wkb = [None] * network.edgecount
+    for feature in features:
+        wkb[network.fidindex[feature[0]]] = feature[1]
+    
+    geoms = shapely.from_wkb(wkb)
+    coords = shapely.get_coordinates(geoms, include_z=True)
+    offsets = numpy.zeros(network.edgecount + 1, dtype=numpy.int64)
+    numpy.cumsum(shapely.get_num_coordinates(geoms), out=offsets[1:])
+    vertices = Vertices(coords, offsets)
+    
+    startz = coords[offsets[:-1], 2].tolist()
+    endz = coords[offsets[1:] - 1, 2].tolist()
+    
+    for i in range(network.edgecount):
+        fromNode = nodes[network.fromnode[i]]
+        toNode = nodes[network.tonode[i]]
         
+        edge = Edge(fromNode, toNode, network.fids[i], i)
+        edges.append(edge)
         
-        for feature in features:
-            geom = shapely.wkb.loads(feature[1] , hex=True)
-            fid = feature[0]
-            
-            startc = geom.coords[0]
-            endc = geom.coords[len(geom.coords)-1]
-            
-            startt = (startc[0], startc[1])
-            endt = (endc[0], endc[1])            
-            
-            if (startt in nodes.keys()):
-                fromNode = nodes[startt]
-            else:
-                #create new node
-                fromNode = Node(startc[0], startc[1])
-                nodes[startt] = fromNode
-            
-            if (endt in nodes.keys()):
-                toNode = nodes[endt]
-            else:
-                #create new node
-                toNode = Node(endc[0], endc[1])
-                nodes[endt] = toNode
-            
-            edge = Edge(fromNode, toNode, fid, geom)
-            edges.append(edge)
-            
-            fromNode.addOutEdge(edge)
-            toNode.addInEdge(edge)            
+        fromNode.addOutEdge(edge, startz[i])
+        toNode.addInEdge(edge, endz[i])            
+    
+    return network, vertices
 
-def processNodes():
+def processNodes(network):
     
-    #walk up network
-    for edge in edges:
-        edge.visited = False
-        
-    toprocess = deque()
-    for node in nodes.values():
+    #walk up network; downstream nodes are always processed
+    #before the nodes that flow into them
+    for n in network.reverseTopologicalOrder():
+        node = nodes[n]
         if (len(node.outedges) == 0):
-            toprocess.append(node)
             node.maxvalue = node.z
-    
-    while (toprocess):
-        node = toprocess.popleft()
         
-        allvisited = True
-        for outedge in node.outedges:
-            if not outedge.visited:
-                allvisited = False;
-                break;
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            #visit this node
-            for inedge in node.inedges:
-                inedge.fromNode.maxvalue = max(node.maxvalue, inedge.fromNode.z)
-                inedge.visited = True
-                toprocess.append(inedge.fromNode)
+        for inedge in node.inedges:
+            inedge.fromNode.maxvalue = max(node.maxvalue, inedge.fromNode.z)
     
     #walk down network        
-    toprocess = deque()
-    for edge in edges:
-        edge.visited = False
-        
-    for node in nodes.values():
+    for node in nodes:
         node.minvalue = node.z
-        if (len(node.inedges) == 0):
-            toprocess.append(node)
-     
-    while (toprocess):
-        node = toprocess.popleft()
+    
+    for n in network.topologicalOrder():
+        node = nodes[n]
         
-        allvisited = True
-        for inedge in node.inedges:
-            if not inedge.visited:
-                allvisited = False;
-                break;
-        if not allvisited:
-            toprocess.append(node)
-        else:
-            #visit this node
-            for outedge in node.outedges:
-                if (node.minvalue == appconfig.NODATA):
-                    outedge.toNode.minvalue = outedge.toNode.minvalue 
-                elif (outedge.toNode.minvalue == appconfig.NODATA):
-                    outedge.toNode.minvalue = node.minvalue
-                else: 
-                    outedge.toNode.minvalue = min(node.minvalue, outedge.toNode.minvalue)
-                                   
-                outedge.visited = True
-                
-                if (outedge.toNode in toprocess):
-                    toprocess.remove(outedge.toNode)
-                toprocess.append(outedge.toNode)     
+        for outedge in node.outedges:
+            if (node.minvalue == appconfig.NODATA):
+                outedge.toNode.minvalue = outedge.toNode.minvalue 
+            elif (outedge.toNode.minvalue == appconfig.NODATA):
+                outedge.toNode.minvalue = node.minvalue
+            else: 
+                outedge.toNode.minvalue = min(node.minvalue, outedge.toNode.minvalue)
     
     #update z values 
-    for node in nodes.values():
+    for node in nodes:
         if (node.maxvalue == appconfig.NODATA or node.minvalue == appconfig.NODATA):
             node.z = appconfig.NODATA
         else:
             node.z = (node.maxvalue + node.minvalue) / 2.0
-        
-    for edge in edges:
-        edge.newz[0] = edge.fromNode.z
-        edge.newz[len(edge.ls.coords)-1] = edge.toNode.z
 
 
-def processEdges():   
+def segmentedAccumulate(ufunc, values, segments):
+    """
+    Running minimum or maximum of values that restarts at each segment
+    in a single accumulate call. Values are replaced by their (exact) 
+    integer rank and offset by segment so earlier segments never affect
+    the result of later ones.
+    :param ufunc: numpy.minimum or numpy.maximum
+    :param values: array of values
+    :param segments: ascending segment index of each value
+    :returns: array of accumulated values
+    """
+    unique, ranks = numpy.unique(values, return_inverse=True)
+    ranks = ranks.reshape(-1).astype(numpy.int64)
+    offset = segments.astype(numpy.int64) * len(unique)
+    if ufunc is numpy.minimum:
+        offset = -offset
+    return unique[ufunc.accumulate(ranks + offset) - offset]
+
+
+def processEdges(vertices):   
+    """
+    Smooths the vertices of each edge between the smoothed elevations 
+    of its end nodes. Vertex elevations are limited to be no lower than 
+    the downstream node and no higher than the upstream node, then the 
+    running minimum (walking downstream) and running maximum (walking 
+    upstream) are averaged. All edges are processed at once over the
+    flat vertex array.
+    """
+    z = vertices.coords[:, 2]
+    offsets = vertices.offsets
+    edgecount = len(offsets) - 1
     
-    for edge in edges:             
-        ls = edge.ls
-        
-        size = len(ls.coords)
-        
-        minvalues = [appconfig.NODATA] * size
-        maxvalues = [appconfig.NODATA] * size
-        
-        absmax = edge.newz[0]
-        absmin = edge.newz[size - 1]
-        
-        minvalues [0] = edge.newz[0]
-        maxvalues [size - 1] = edge.newz[size - 1]
-        
-        
-        for i in range(1, size):
-            temp = ls.coords[i][2]
-            if (temp < absmin):
-                temp = absmin
-            minv = min(temp, minvalues[i-1])
-            minvalues[i] = minv
-            
-            temp = ls.coords[size - 1 - i][2]
-            if (temp > absmax):
-                temp = absmax
-            maxv = max(temp, maxvalues[size - i])
-            maxvalues [size - 1 - i ] = maxv
-        
-        for i in range(0, size):
-            if minvalues[i] == appconfig.NODATA or maxvalues[i] == appconfig.NODATA:
-                edge.newz[i] = appconfig.NODATA
-            else:
-                edge.newz[i] = ((minvalues[i] + maxvalues[i]) / 2.0)
+    fromz = numpy.full(edgecount, appconfig.NODATA, dtype=numpy.float64)
+    toz = numpy.full(edgecount, appconfig.NODATA, dtype=numpy.float64)
+    for edge in edges:
+        fromz[edge.index] = edge.fromNode.z
+        toz[edge.index] = edge.toNode.z
+    
+    counts = numpy.diff(offsets)
+    edgeindex = numpy.repeat(numpy.arange(edgecount), counts)
+    starts = offsets[:-1][counts > 0]
+    ends = offsets[1:][counts > 0] - 1
+    
+    minvalues = numpy.maximum(z, toz[edgeindex])
+    minvalues[starts] = fromz[counts > 0]
+    minvalues = segmentedAccumulate(numpy.minimum, minvalues, edgeindex)
+    
+    #accumulate each edge in reverse order over the reversed array
+    maxvalues = numpy.minimum(z, fromz[edgeindex])
+    maxvalues[ends] = toz[counts > 0]
+    maxvalues = segmentedAccumulate(numpy.maximum, maxvalues[::-1], (edgecount - 1 - edgeindex)[::-1])[::-1]
+    
+    nodata = (minvalues == appconfig.NODATA) | (maxvalues == appconfig.NODATA)
+    vertices.newz = numpy.where(nodata, appconfig.NODATA, (minvalues + maxvalues) / 2.0)
         
         
-def writeResults(connection):
+def writeResults(connection, vertices):
     
-    updatequery = f"""
-        UPDATE {dbTargetSchema}.{dbTargetTable} 
-        set {dbTargetGeom} = st_setsrid(st_geomfromwkb(%s),{appconfig.dataSrid})
-        WHERE  {appconfig.dbIdField} = %s
-    """
-    
-    newdata = []
+    #build all geometries in a single batch
+    edgeindex = numpy.repeat(numpy.arange(len(edges)), numpy.diff(vertices.offsets))
+    pnts = numpy.column_stack((vertices.coords[:, 0:2], vertices.newz))
+    wkb = shapely.to_wkb(shapely.linestrings(pnts, indices=edgeindex))
     
-    for edge in edges:
-        newpnts = [];
-        for i in range(0, len(edge.ls.coords)):
-            x = edge.ls.coords[i][0]
-            y = edge.ls.coords[i][1]
-            z = edge.newz[i]
-            newpnts.append((x,y,z))
-        ls = shapely.geometry.LineString(newpnts)
-        newdata.append( (shapely.wkb.dumps(ls), edge.fid))
+    newdata = [(edge.fid, wkb[edge.index]) for edge in edges]
     
-    with connection.cursor() as cursor:    
-        psycopg2.extras.execute_batch(cursor, updatequery, newdata);
+    bulk_update.updateTable(connection, f"{dbTargetSchema}.{dbTargetTable}", appconfig.dbIdField,
+        [("id", "uuid"), ("geometry", "geometry")], newdata,
+        {dbTargetGeom: f"st_setsrid(s.geometry, {appconfig.dataSrid})"})
             
     connection.commit()
     
@@ -273,16 +252,16 @@ def main():
             cursor.execute(query)
         
         print("  creating network")
-        createNetwork(conn)
+        network, vertices = createNetwork(conn)
         
         print("  processing nodes")
-        processNodes()
+        processNodes(network)
         
         print("  processing edges")
-        processEdges()
+        processEdges(vertices)
         
         print("  writing results")
-        writeResults(conn)
+        writeResults(conn, vertices)
         # replace index on geometry field
         query = f"""
             DROP INDEX IF EXISTS {dbTargetSchema}.{dbTargetSchema}_{dbTargetTable}_geometry_idx;
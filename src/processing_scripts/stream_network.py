@@ -0,0 +1,214 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2023 by Canadian Wildlife Federation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Shared in-memory stream network used by the scripts that traverse
+# the network (smoothing, mainstems, barrier and habitat statistics).
+#
+# Only the stream ids and the start/end points of each stream are loaded
+# (no geometry decoding). Nodes are identified by their exact xy location
+# and the topology is stored as integer indexed compressed sparse row (CSR)
+# adjacency arrays:
+#   * edges are indexed 0..edgecount-1 in the order they are loaded
+#   * nodes are indexed 0..nodecount-1
+#   * the out edges of node n are outedges[outptr[n]:outptr[n+1]]
+#   * the in edges of node n are inedges[inptr[n]:inptr[n+1]]
+#
+# The network is cached for the life of the process; any script that
+# modifies the stream geometries must call clearNetwork().
+#
+import appconfig
+import numpy as np
+from collections import deque
+
+iniSection = appconfig.args.args[0]
+dbTargetSchema = appconfig.config[iniSection]['output_schema']
+dbTargetStreamTable = appconfig.config['PROCESSING']['stream_table']
+
+network = None
+
+class StreamNetwork:
+
+    def __init__(self, fids, fromnode, tonode, nodexy):
+        self.fids = fids
+        self.fidindex = {fid: i for i, fid in enumerate(fids)}
+        self.fromnode = fromnode
+        self.tonode = tonode
+        self.nodexy = nodexy
+        self.edgecount = len(fids)
+        self.nodecount = len(nodexy)
+
+        self.outptr, self.outedges = buildAdjacency(fromnode, self.nodecount)
+        self.inptr, self.inedges = buildAdjacency(tonode, self.nodecount)
+
+        self.toporder = None
+        self.toplevels = None
+
+    def getOutEdges(self, node):
+        return self.outedges[self.outptr[node]:self.outptr[node + 1]]
+
+    def getInEdges(self, node):
+        return self.inedges[self.inptr[node]:self.inptr[node + 1]]
+
+    def outDegree(self):
+        return np.diff(self.outptr)
+
+    def inDegree(self):
+        return np.diff(self.inptr)
+
+    def topologicalOrder(self):
+        """
+        Kahn's algorithm over the nodes of the network. The order is computed
+        once per network so each accumulation pass is a single linear sweep.
+        :returns: array of node indexes ordered from upstream to downstream;
+            every node appears after all the nodes that flow into it
+        """
+        if self.toporder is not None:
+            return self.toporder
+
+        indegree = self.inDegree().tolist()
+        outptr = self.outptr.tolist()
+        outedges = self.outedges.tolist()
+        tonode = self.tonode.tolist()
+
+        toprocess = deque(n for n in range(self.nodecount) if indegree[n] == 0)
+        order = []
+
+        while (toprocess):
+            node = toprocess.popleft()
+            order.append(node)
+            for edge in outedges[outptr[node]:outptr[node + 1]]:
+                downnode = tonode[edge]
+                indegree[downnode] -= 1
+                if (indegree[downnode] == 0):
+                    toprocess.append(downnode)
+
+        if (len(order) < self.nodecount):
+            #cycles in the network; these nodes can never be ordered
+            #so add them at the end to ensure every edge is visited
+            print("  WARNING: stream network contains " + str(self.nodecount - len(order)) + " nodes in cycles")
+            ordered = np.zeros(self.nodecount, dtype=bool)
+            ordered[order] = True
+            order.extend(np.flatnonzero(~ordered).tolist())
+
+        self.toporder = np.array(order, dtype=np.int64)
+        return self.toporder
+
+    def reverseTopologicalOrder(self):
+        """
+        :returns: array of node indexes ordered from downstream to upstream;
+            every node appears after all the nodes it flows into
+        """
+        return self.topologicalOrder()[::-1]
+
+    def topologicalLevels(self):
+        """
+        Groups the nodes into levels that can be processed together; every
+        node is at a higher level than all the nodes that flow into it
+        :returns: array of the level of each node (source nodes are level 0)
+        """
+        if self.toplevels is not None:
+            return self.toplevels
+
+        levels = [0] * self.nodecount
+        inptr = self.inptr.tolist()
+        inedges = self.inedges.tolist()
+        fromnode = self.fromnode.tolist()
+
+        for node in self.topologicalOrder().tolist():
+            for edge in inedges[inptr[node]:inptr[node + 1]]:
+                if (levels[fromnode[edge]] + 1 > levels[node]):
+                    levels[node] = levels[fromnode[edge]] + 1
+
+        self.toplevels = np.array(levels, dtype=np.int64)
+        return self.toplevels
+
+    def loadAttributes(self, connection, fields):
+        """
+        Loads additional stream attributes for every edge in the network
+        :param connection: database connection
+        :param fields: list of fields (or sql expressions) to load
+        :returns: list of tuples (one value per field) indexed by edge
+        """
+        query = f"""
+            SELECT {appconfig.dbIdField}, {', '.join(fields)}
+            FROM {dbTargetSchema}.{dbTargetStreamTable}
+        """
+
+        values = [None] * self.edgecount
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+            for feature in cursor.fetchall():
+                values[self.fidindex[feature[0]]] = feature[1:]
+        return values
+
+
+def buildAdjacency(nodeindex, nodecount):
+    """
+    Builds CSR adjacency arrays grouping edges by the provided node index
+    :returns: (pointer array of length nodecount + 1, edge index array)
+    """
+    edges = np.argsort(nodeindex, kind='stable')
+    ptr = np.zeros(nodecount + 1, dtype=np.int64)
+    np.cumsum(np.bincount(nodeindex, minlength=nodecount), out=ptr[1:])
+    return ptr, edges
+
+
+def createNetwork(connection):
+
+    query = f"""
+        SELECT {appconfig.dbIdField},
+            st_x(st_startpoint({appconfig.dbGeomField})), st_y(st_startpoint({appconfig.dbGeomField})),
+            st_x(st_endpoint({appconfig.dbGeomField})), st_y(st_endpoint({appconfig.dbGeomField}))
+        FROM {dbTargetSchema}.{dbTargetStreamTable}
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute(query)
+        features = cursor.fetchall()
+
+    fids = [feature[0] for feature in features]
+    ends = np.array([feature[1:5] for feature in features], dtype=np.float64).reshape(-1, 4)
+
+    #nodes are the unique end point locations
+    points = np.concatenate((ends[:, 0:2], ends[:, 2:4]))
+    nodexy, nodeindex = np.unique(points, axis=0, return_inverse=True)
+    nodeindex = nodeindex.reshape(-1).astype(np.int64)
+
+    return StreamNetwork(fids, nodeindex[:len(fids)], nodeindex[len(fids):], nodexy)
+
+
+def getNetwork(connection):
+    """
+    Returns the stream network, loading it from the database
+    if it hasn't been loaded yet
+    """
+    global network
+
+    if network is None:
+        network = createNetwork(connection)
+    return network
+
+
+def clearNetwork():
+    """
+    Clears the cached network; must be called whenever
+    the stream geometries are modified
+    """
+    global network
+    network = None
@@ -0,0 +1,119 @@
+#----------------------------------------------------------------------------------
+#
+# Copyright 2023 by Canadian Wildlife Federation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#----------------------------------------------------------------------------------
+
+#
+# Accumulation of the upstream habitat metrics over the stream network
+# arrays. This module has no database or configuration dependencies so
+# the accumulation can be run (and benchmarked) on synthetic networks.
+#
+# Edges are indexed 0..edgecount-1 and flow from fromnode[e] to tonode[e].
+# Per species arrays have one column per species; the habitat flags and
+# metric values have one extra column (the last) for all species combined.
+#
+import numpy as np
+
+#upstream metrics accumulated for each species as (name, weighted, habitat, functional);
+#each metric is the length (or weighted length) of the upstream edges that have
+#the habitat; functional metrics only include the edges upstream up to the next
+#barrier
+METRICS = [
+    ('total_upstr_pot_access', False, 'access', False),
+    ('total_upstr_hab_spawn', False, 'spawn', False),
+    ('total_upstr_hab_rear', False, 'rear', False),
+    ('total_upstr_hab', False, 'habitat', False),
+    ('func_upstr_hab_spawn', False, 'spawn', True),
+    ('func_upstr_hab_rear', False, 'rear', True),
+    ('func_upstr_hab', False, 'habitat', True),
+    ('w_total_upstr_hab', True, 'habitat', False),
+    ('w_func_upstr_hab', True, 'habitat', True),
+]
+
+#metrics also computed for all species combined (an edge is
+#habitat for all species if it is habitat for any species)
+ALL_METRICS = [
+    'total_upstr_hab_spawn', 'total_upstr_hab_rear', 'total_upstr_hab',
+    'func_upstr_hab_spawn', 'func_upstr_hab_rear', 'func_upstr_hab'
+]
+
+
+def accumulateMetrics(species, fromnode, tonode, nodelevels, length, w_length, habitat, upbarriercnt):
+    """
+    Accumulates the upstream metrics of every edge, species and metric at
+    once. Nodes are processed one topological level at a time; the values
+    of the edges leaving the nodes of a level are the edge's own contribution
+    plus the sum of the values of the edges flowing into the node.
+
+    :param species: list of species codes
+    :param fromnode: upstream node index of each edge
+    :param tonode: downstream node index of each edge
+    :param nodelevels: topological level of each node; every node is at a
+        higher level than all the nodes that flow into it
+    :param length: length of each edge
+    :param w_length: weighted length of each edge
+    :param habitat: dictionary of habitat type to (edge, species + 1) flags
+    :param upbarriercnt: (edge, species) number of barriers upstream
+    :returns: (edge, species + 1, metric) array of upstream metric values
+    """
+    nodecount = len(nodelevels)
+
+    #contribution of each edge to each species and metric
+    basis = np.column_stack([w_length if weighted else length for name, weighted, habitattype, functional in METRICS])
+    flags = np.stack([habitat[habitattype] for name, weighted, habitattype, functional in METRICS], axis=2)
+    increment = basis[:, np.newaxis, :] * flags
+
+    #functional metrics restart on edges with a different number of barriers
+    #upstream than the sum of the edges flowing into it (for all species
+    #combined if this is the case for any species)
+    inbarriercnt = np.zeros((nodecount, len(species)), dtype=np.int64)
+    np.add.at(inbarriercnt, tonode, upbarriercnt)
+    restart = upbarriercnt != inbarriercnt[fromnode]
+    restart = np.column_stack((restart, restart.any(axis=1)))
+    functional = np.array([functional for name, weighted, habitattype, functional in METRICS], dtype=bool)
+    keep = ~(restart[:, :, np.newaxis] & functional)
+
+    values = np.zeros(increment.shape, dtype=np.float64)
+    nodevalues = np.zeros((nodecount,) + increment.shape[1:], dtype=np.float64)
+
+    #walk down network one level at a time; upstream nodes are always
+    #at a lower level than the nodes they flow into
+    edgelevels = nodelevels[fromnode]
+    order = np.argsort(edgelevels, kind='stable')
+    bounds = np.flatnonzero(np.diff(edgelevels[order])) + 1
+
+    for group in np.split(order, bounds):
+        values[group] = increment[group] + np.where(keep[group], nodevalues[fromnode[group]], 0)
+        np.add.at(nodevalues, tonode[group], values[group])
+
+    return values
+
+
+def computeHabitatDCI(species, length, habitat, downpassability):
+    """
+    :param species: list of species codes
+    :param length: length of each edge
+    :param habitat: (edge, species) habitat flags
+    :param downpassability: (edge, species) product of the passability
+        of the barriers downstream of each edge
+    :returns: (edge, species) array of the dci of each habitat edge
+    """
+    habitat = habitat[:, :len(species)]
+
+    #total habitat length of each species
+    total_length = (length[:, np.newaxis] * habitat).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(habitat, (length[:, np.newaxis] / total_length) * downpassability * 100, 0)
@@ -56,11 +56,9 @@ compute_mainstems.main()
 assign_raw_z.main()
 smooth_z.main()
 compute_vertex_gradient.main()
+#elevations are carried through to the broken streams
+#so they do not need to be recalculated
 break_streams_at_barriers.main()
-print ("Recalculating elevations on broken streams: " + workingWatershedId)
-# re-assign elevations to broken streams
-assign_raw_z.main()
-smooth_z.main()
 compute_segment_gradient.main()
 compute_updown_barriers_fish.main()
 compute_accessibility.main()